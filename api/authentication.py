@@ -0,0 +1,77 @@
+import copy
+
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from api.caches import ExpiringLRUCache
+from lbdev_chat import metrics
+
+hits_counter = metrics.counter("auth_token_cache_hits_total", "Token lookups answered by the token cache.")
+misses_counter = metrics.counter("auth_token_cache_misses_total", "Token lookups that had to query the database.")
+
+
+class TokenCache(ExpiringLRUCache):
+    """
+    ``Token`` instances (with their user) keyed by token key, sized by AUTH_TOKEN_CACHE_SIZE and AUTH_TOKEN_CACHE_TTL.
+
+    Every lookup returns its own copy of the token and user, so the permission caches ``ModelBackend`` stores on a
+    user stay with one request. Token deletion, user deactivation and permission changes invalidate entries through
+    the signals in ``api.signals``, the TTL bounds staleness for changes made by other processes.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        super().__init__(
+            "AUTH_TOKEN_CACHE_SIZE", "AUTH_TOKEN_CACHE_TTL", hits_counter, misses_counter, max_size=max_size, ttl=ttl
+        )
+
+    @staticmethod
+    def _copy(token):
+        token = copy.copy(token)
+        token.user = copy.copy(token.user)
+        return token
+
+    def get(self, key):
+        token = super().get(key)
+        return None if token is None else self._copy(token)
+
+    def set(self, key, token):
+        super().set(key, self._copy(token))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in [key for key, (expires_at, token) in self._entries.items() if token.user_id == user_id]:
+                del self._entries[key]
+
+
+token_cache = TokenCache()
+
+
+def load_token(key):
+    token = Token.objects.select_related('user').get(key=key)
+    token_cache.set(key, token)
+    return token
+
+
+def get_token(key):
+    """
+    Return the ``Token`` for ``key`` from the cache or the database, raises ``Token.DoesNotExist``.
+    """
+    token = token_cache.get(key)
+    if token is None:
+        token = load_token(key)
+    return token
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        try:
+            token = get_token(key)
+        except Token.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        return (token.user, token)
@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+from channels.db import database_sync_to_async
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.test import AsyncClient
+
+from chat.benchmarks import summarize, unique_prefix
+
+BENCH_PASSWORD = "bench-password"
+
+
+@database_sync_to_async
+def create_users(count):
+    prefix = unique_prefix("login")
+    password = make_password(BENCH_PASSWORD)
+    User.objects.bulk_create([User(username="{}{}".format(prefix, index), password=password) for index in range(count)])
+    return list(User.objects.filter(username__startswith=prefix).values_list("username", flat=True))
+
+
+async def run_login_benchmark(users=20, requests=200, concurrency=20, path="/api/login/"):
+    """
+    Logins per second and latency of ``requests`` logins sent ``concurrency`` at a time.
+    """
+    usernames = await create_users(users)
+    client = AsyncClient()
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async def login(index):
+        async with slots:
+            started_at = time.perf_counter()
+            response = await client.post(path, {"username": usernames[index % len(usernames)],
+                                                "password": BENCH_PASSWORD}, content_type="application/json")
+            latencies.append(time.perf_counter() - started_at)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(login(index) for index in range(requests)))
+    elapsed = time.perf_counter() - started_at
+
+    return {
+        "path": path,
+        "users": users,
+        "requests": requests,
+        "concurrency": concurrency,
+        "statuses": statuses,
+        "logins_per_second": statuses.get(200, 0) / elapsed,
+        "latency_ms": summarize(latencies),
+    }
@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class ExpiringLRUCache:
+    """
+    Bounded LRU cache whose entries expire ``ttl`` seconds after they are set.
+
+    ``max_size`` and ``ttl`` default to the settings named ``size_setting`` and ``ttl_setting``, read on every use
+    so they follow settings overrides. Lookups are counted in ``hits_counter`` and ``misses_counter``.
+    """
+
+    def __init__(self, size_setting, ttl_setting, hits_counter, misses_counter, max_size=None, ttl=None):
+        self.size_setting = size_setting
+        self.ttl_setting = ttl_setting
+        self.hits_counter = hits_counter
+        self.misses_counter = misses_counter
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            return getattr(settings, self.size_setting)
+        return self._max_size
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            return getattr(settings, self.ttl_setting)
+        return self._ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits_counter.inc()
+                    return value
+                del self._entries[key]
+        self.misses_counter.inc()
+        return None
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
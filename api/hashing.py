@@ -0,0 +1,63 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib import auth
+from django.db import close_old_connections
+
+from lbdev_chat import metrics
+
+rejections_counter = metrics.counter(
+    "auth_hash_rejections_total",
+    "Logins rejected because AUTH_HASH_MAX_PENDING password hashes were already pending."
+)
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def get_executor():
+    """
+    Process wide pool for password hashing, sized by AUTH_HASH_WORKERS so a login spike cannot take every CPU.
+    """
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.AUTH_HASH_WORKERS, thread_name_prefix="auth-hash")
+            _slots = threading.BoundedSemaphore(settings.AUTH_HASH_MAX_PENDING)
+        return _executor
+
+
+async def run(func, *args):
+    executor = get_executor()
+    if not _slots.acquire(blocking=False):
+        rejections_counter.inc()
+        raise HashingBusy()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    finally:
+        _slots.release()
+
+
+def _authenticate(request, username, password):
+    close_old_connections()
+    try:
+        return auth.authenticate(request, username=username, password=password)
+    finally:
+        close_old_connections()
+
+
+async def authenticate(request, username, password):
+    """
+    ``django.contrib.auth.authenticate`` in the bounded executor.
+
+    Every AUTHENTICATION_BACKENDS backend and the ``user_login_failed`` signal still apply. Backends hash inside
+    ``authenticate``, so the whole call leaves the event loop and the shared database threads.
+    """
+    return await run(_authenticate, request, username, password)
@@ -0,0 +1,24 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+
+from api.benchmarks import run_login_benchmark
+from chat.benchmarks import throwaway_database, write_report
+
+
+class Command(BaseCommand):
+    help = "Measure logins per second under concurrency against a throwaway test database and print a JSON report."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="Distinct users logging in.")
+        parser.add_argument("--requests", type=int, default=200, help="Login requests sent.")
+        parser.add_argument("--concurrency", type=int, default=20, help="Requests in flight at the same time.")
+        parser.add_argument("--path", default="/api/login/", help="'/api/login/sync/' measures the sync view.")
+        parser.add_argument("--output", help="File the JSON report is written to.")
+
+    def handle(self, *args, **options):
+        with throwaway_database():
+            report = async_to_sync(run_login_benchmark)(
+                options["users"], options["requests"], options["concurrency"], options["path"]
+            )
+
+        self.stdout.write(write_report(report, options["output"]))
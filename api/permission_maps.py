@@ -0,0 +1,46 @@
+from api.caches import ExpiringLRUCache
+from lbdev_chat import metrics
+
+hits_counter = metrics.counter("auth_permission_cache_hits_total", "Permission maps answered by the cache.")
+misses_counter = metrics.counter("auth_permission_cache_misses_total", "Permission maps built from the database.")
+
+
+class PermissionMapCache(ExpiringLRUCache):
+    """
+    Permission map of every user keyed by user id, sized by AUTH_PERMISSION_CACHE_SIZE and AUTH_PERMISSION_CACHE_TTL.
+
+    Group and permission changes invalidate entries through the signals in ``api.signals``, the TTL bounds
+    staleness for changes made by other processes.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        super().__init__(
+            "AUTH_PERMISSION_CACHE_SIZE", "AUTH_PERMISSION_CACHE_TTL", hits_counter, misses_counter,
+            max_size=max_size, ttl=ttl
+        )
+
+
+permission_cache = PermissionMapCache()
+
+
+def build_permission_map(user):
+    permissions = {}
+    for permission in user.get_all_permissions():
+        _split_perm = permission.split('.')[1]
+        _split = _split_perm.split('_')
+        if _split[1] not in permissions:
+            permissions[_split[1]] = [_split[0]]
+        else:
+            permissions[_split[1]].append(_split[0])
+    return permissions
+
+
+def get_permission_map(user):
+    """
+    Actions allowed to ``user`` grouped by model, e.g. ``{"chat": ["add", "view"]}``.
+    """
+    permissions = permission_cache.get(user.pk)
+    if permissions is None:
+        permissions = build_permission_map(user)
+        permission_cache.set(user.pk, permissions)
+    return permissions
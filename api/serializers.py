@@ -4,6 +4,8 @@ from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
 from django.utils.translation import gettext_lazy as _
 
+from api.permission_maps import get_permission_map
+
 
 class DynamicFieldsModelSerializer(serializers.ModelSerializer):
     """
@@ -79,15 +81,7 @@ class UserSerializer(DynamicFieldsModelSerializer):
 
     @staticmethod
     def list_permissions(user):
-        permissions = {}
-        for permission in user.get_all_permissions():
-            _split_perm = permission.split('.')[1]
-            _split = _split_perm.split('_')
-            if _split[1] not in permissions:
-                permissions[_split[1]] = [_split[0]]
-            else:
-                permissions[_split[1]].append(_split[0])
-        return permissions
+        return get_permission_map(user)
 
     class Meta:
         model = User
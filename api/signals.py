@@ -0,0 +1,56 @@
+from django.contrib.auth.models import Group, Permission, User
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from api.authentication import token_cache
+from api.permission_maps import permission_cache
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, update_fields=None, **kwargs):
+    # Cached tokens hold a copy of the user and superusers are granted every permission, refresh both when one of
+    # the flags may have changed.
+    if update_fields is None or {'is_active', 'is_superuser'} & set(update_fields):
+        token_cache.invalidate_user(instance.pk)
+        permission_cache.invalidate(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user_tokens(sender, instance, **kwargs):
+    token_cache.invalidate_user(instance.pk)
+    permission_cache.invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_user_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if isinstance(instance, User):
+        token_cache.invalidate_user(instance.pk)
+        permission_cache.invalidate(instance.pk)
+    elif pk_set is not None:
+        for user_id in pk_set:
+            token_cache.invalidate_user(user_id)
+            permission_cache.invalidate(user_id)
+    else:
+        # A group or permission cleared of all its users, the user ids are not known anymore.
+        token_cache.clear()
+        permission_cache.clear()
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+def invalidate_group_permissions(sender, **kwargs):
+    # Changing a group reaches all of its members, rare enough to drop every map.
+    if kwargs.get('action', 'post_').startswith('post_'):
+        token_cache.clear()
+        permission_cache.clear()
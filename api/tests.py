@@ -1,3 +1,204 @@
-from django.test import TestCase
+import threading
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.auth.signals import user_login_failed
+from django.test import AsyncClient, TransactionTestCase, override_settings
+from rest_framework.authtoken.models import Token
+
+from api import authentication, hashing
+from api.authentication import TokenCache, get_token, token_cache
+from api.benchmarks import run_login_benchmark
+from api.permission_maps import get_permission_map, permission_cache
+
+
+class ThreadRecordingBackend(ModelBackend):
+    threads = []
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        self.threads.append(threading.current_thread().name)
+        return super().authenticate(request, username=username, password=password, **kwargs)
+
+
+class AsyncLoginTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', password='secret')
+
+    def login(self, **data):
+        return async_to_sync(AsyncClient().post)('/api/login/', data, content_type='application/json')
+
+    def test_login(self):
+        response = self.login(username='owner', password='secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['token'], self.user.auth_token.key)
+        self.assertEqual(response.json()['data']['username'], 'owner')
+
+    def test_invalid_credentials(self):
+        self.assertEqual(self.login(username='owner', password='wrong').status_code, 400)
+        self.assertEqual(self.login(username='nobody', password='secret').status_code, 400)
+        self.assertEqual(self.login(username='owner').json(), {'non_field_errors': [{'password': 'required'}]})
+
+    def test_long_credentials_are_rejected_before_hashing(self):
+        with mock.patch.object(hashing, 'authenticate') as authenticate:
+            response = self.login(username='owner', password='x' * 256)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()), ['password'])
+        authenticate.assert_not_called()
+        self.assertEqual(self.login(username='o' * 151, password='secret').status_code, 400)
+
+    def test_failed_login_sends_signal(self):
+        failures = []
+
+        def receiver(sender, credentials, **kwargs):
+            failures.append(credentials['username'])
+
+        user_login_failed.connect(receiver)
+        self.addCleanup(user_login_failed.disconnect, receiver)
+        self.login(username='owner', password='wrong')
+
+        self.assertEqual(failures, ['owner'])
+
+    @override_settings(AUTHENTICATION_BACKENDS=['api.tests.ThreadRecordingBackend'])
+    def test_configured_backends_run_in_executor(self):
+        ThreadRecordingBackend.threads.clear()
+
+        self.assertEqual(self.login(username='owner', password='secret').status_code, 200)
+        self.assertTrue(ThreadRecordingBackend.threads[0].startswith('auth-hash'))
+
+    def test_hashing_runs_in_executor(self):
+        thread_name = async_to_sync(hashing.run)(lambda: threading.current_thread().name)
+
+        self.assertTrue(thread_name.startswith('auth-hash'))
+
+    def test_busy_executor_answers_503(self):
+        hashing.get_executor()
+        with mock.patch.object(hashing, '_slots', threading.BoundedSemaphore(1)) as slots:
+            slots.acquire()
+            response = self.login(username='owner', password='secret')
+
+        self.assertEqual(response.status_code, 503)
+
+    def test_benchmark_report(self):
+        report = async_to_sync(run_login_benchmark)(users=2, requests=4, concurrency=2)
+
+        self.assertEqual(report["statuses"], {200: 4})
+
+
+class PermissionMapTestCase(TransactionTestCase):
+    def setUp(self):
+        permission_cache.clear()
+        self.user = User.objects.create(username='owner')
+        self.permission = Permission.objects.get(codename='view_chat')
+
+    def permission_map(self):
+        # A fresh instance, the user caches its permissions on itself.
+        return get_permission_map(User.objects.get(pk=self.user.pk))
+
+    def test_user_permissions_invalidate(self):
+        self.assertEqual(self.permission_map(), {})
+
+        self.user.user_permissions.add(self.permission)
+
+        self.assertEqual(self.permission_map(), {'chat': ['view']})
+
+    def test_group_permissions_invalidate(self):
+        group = Group.objects.create(name='readers')
+        self.user.groups.add(group)
+        self.assertEqual(self.permission_map(), {})
+
+        group.permissions.add(self.permission)
+
+        self.assertEqual(self.permission_map(), {'chat': ['view']})
+
+
+class TokenCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create(username='owner')
+        self.token = Token.objects.create(user=self.user)
+
+    def test_hits_and_misses_are_counted(self):
+        hits, misses = authentication.hits_counter.value(), authentication.misses_counter.value()
+
+        get_token(self.token.key)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_token(self.token.key).user, self.user)
+
+        self.assertEqual(authentication.hits_counter.value(), hits + 1)
+        self.assertEqual(authentication.misses_counter.value(), misses + 1)
+
+    def test_entries_expire(self):
+        cache = TokenCache(max_size=10, ttl=60)
+        with mock.patch('api.caches.time.monotonic', return_value=100):
+            cache.set('key', self.token)
+        with mock.patch('api.caches.time.monotonic', return_value=159):
+            self.assertEqual(cache.get('key'), self.token)
+        with mock.patch('api.caches.time.monotonic', return_value=161):
+            self.assertIsNone(cache.get('key'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        cache.set('a', self.token)
+        cache.set('b', self.token)
+        cache.get('a')
+        cache.set('c', self.token)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), self.token)
+        self.assertEqual(cache.get('c'), self.token)
+
+    def test_deleted_token_is_invalidated(self):
+        get_token(self.token.key)
+
+        self.token.delete()
+
+        with self.assertRaises(Token.DoesNotExist):
+            get_token(self.token.key)
+
+    def test_deactivated_user_is_invalidated(self):
+        get_token(self.token.key)
+
+        self.user.is_active = False
+        self.user.save(update_fields=['is_active'])
+
+        self.assertFalse(get_token(self.token.key).user.is_active)
+
+    def test_deleted_user_is_invalidated(self):
+        get_token(self.token.key)
+
+        self.user.delete()
+
+        with self.assertRaises(Token.DoesNotExist):
+            get_token(self.token.key)
+
+    def test_other_updates_keep_the_entry(self):
+        get_token(self.token.key)
+
+        self.user.first_name = 'Owner'
+        self.user.save(update_fields=['first_name'])
+
+        with self.assertNumQueries(0):
+            get_token(self.token.key)
+
+    def test_lookups_get_their_own_user(self):
+        first, second = get_token(self.token.key), get_token(self.token.key)
+
+        self.assertIsNot(first.user, second.user)
+        self.assertEqual(first.user, second.user)
+
+    def test_permission_changes_reach_cached_tokens(self):
+        permission = Permission.objects.get(codename='add_token')
+        self.assertFalse(get_token(self.token.key).user.has_perm('authtoken.add_token'))
+
+        self.user.user_permissions.add(permission)
+
+        self.assertTrue(get_token(self.token.key).user.has_perm('authtoken.add_token'))
+        group = Group.objects.create(name='editors')
+        self.user.groups.add(group)
+        self.assertFalse(get_token(self.token.key).user.has_perm('authtoken.change_token'))
+        group.permissions.add(Permission.objects.get(codename='change_token'))
+        self.assertTrue(get_token(self.token.key).user.has_perm('authtoken.change_token'))
@@ -3,5 +3,6 @@ from django.urls import path
 from api import views
 
 urlpatterns = [
-    path('login/', views.LoginAuthToken.as_view()),
+    path('login/', views.async_login),
+    path('login/sync/', views.LoginAuthToken.as_view()),
 ]
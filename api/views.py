@@ -1,4 +1,9 @@
-from django.contrib.auth import login
+import json
+import time
+
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model, login
+from django.http import JsonResponse
 from django.shortcuts import render
 
 # Create your views here.
@@ -7,8 +12,21 @@ from rest_framework.authtoken.models import Token
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
 
-from api import serializers
+from api import hashing, serializers
 from api.serializers import UserSerializer
+from lbdev_chat import metrics
+
+login_latency_histogram = metrics.histogram(
+    "auth_login_seconds",
+    "Time to answer a login request, labelled by result.",
+    buckets=metrics.LATENCY_BUCKETS
+)
+
+# Same limits as LoginSerializer and the user model, longer credentials never reach the hashing executor.
+CREDENTIAL_MAX_LENGTHS = {
+    'username': get_user_model()._meta.get_field('username').max_length,
+    'password': serializers.LoginSerializer().fields['password'].max_length
+}
 
 
 class LoginAuthToken(GenericAPIView):
@@ -31,3 +49,73 @@ class LoginAuthToken(GenericAPIView):
             return Response(data, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+
+
+@database_sync_to_async
+def issue_token(request, user):
+    token, created = Token.objects.get_or_create(user=user)
+    login(request, user)
+    return {
+        'token': token.key,
+        'data': UserSerializer(instance=user, read_only=True).data
+    }
+
+
+def _login_data(request):
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
+
+
+async def async_login(request):
+    """
+    Same contract as ``LoginAuthToken``, ``authenticate`` runs in the bounded ``api.hashing`` executor so a
+    login spike does not hold the event loop or the shared sync thread.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'detail': 'Method "{}" not allowed.'.format(request.method)},
+                            status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    started_at = time.perf_counter()
+    data = _login_data(request)
+    if data is None:
+        return JsonResponse({'detail': 'JSON parse error'}, status=status.HTTP_400_BAD_REQUEST)
+
+    username, password = data.get('username'), data.get('password')
+    missing = {field: 'required' for field, value in (('username', username), ('password', password)) if not value}
+    if missing:
+        return JsonResponse({'non_field_errors': [missing]}, status=status.HTTP_400_BAD_REQUEST)
+
+    username, password = str(username), str(password)
+    too_long = {
+        field: ['Ensure this field has no more than {} characters.'.format(CREDENTIAL_MAX_LENGTHS[field])]
+        for field, value in (('username', username), ('password', password))
+        if len(value) > CREDENTIAL_MAX_LENGTHS[field]
+    }
+    if too_long:
+        return JsonResponse(too_long, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        user = await hashing.authenticate(request, username, password)
+    except hashing.HashingBusy:
+        login_latency_histogram.observe(time.perf_counter() - started_at, result='busy')
+        response = JsonResponse({'detail': 'Too many login attempts, try again later.'},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = '1'
+        return response
+
+    if user is None:
+        login_latency_histogram.observe(time.perf_counter() - started_at, result='rejected')
+        return JsonResponse({'non_field_errors': ['User not found']}, status=status.HTTP_400_BAD_REQUEST)
+
+    response = JsonResponse(await issue_token(request, user), status=status.HTTP_200_OK)
+    login_latency_histogram.observe(time.perf_counter() - started_at, result='success')
+    return response
+
+
+# Token authenticated API, like the DRF views. csrf_exempt would wrap the coroutine in a sync function.
+async_login.csrf_exempt = True
@@ -0,0 +1,135 @@
+import collections
+import datetime
+import gzip
+import json
+import threading
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+
+from chat.models import ArchiveSegment, ChatHistory
+from lbdev_chat import metrics
+
+archived_counter = metrics.counter("chat_archived_messages_total", "ChatHistory rows moved to archive segments.")
+segment_reads_counter = metrics.counter(
+    "chat_archive_segment_reads_total",
+    "Archive segments read from storage, labelled by cache result."
+)
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_cutoff(days=None):
+    if days is None:
+        days = settings.CHAT_ARCHIVE_AFTER_DAYS
+    return timezone.now() - datetime.timedelta(days=days)
+
+
+def encode_segment(rows):
+    lines = (
+        json.dumps([pk, sender_id, content, created_at.isoformat(), received_at and received_at.isoformat()])
+        for pk, sender_id, content, created_at, received_at in rows
+    )
+    return gzip.compress("\n".join(lines).encode())
+
+
+def decode_segment(data):
+    rows = []
+    for line in gzip.decompress(data).decode().splitlines():
+        pk, sender_id, content, created_at, received_at = json.loads(line)
+        rows.append((pk, sender_id, content, datetime.datetime.fromisoformat(created_at)))
+    return rows
+
+
+def read_segment(segment):
+    """
+    Rows ``(id, sender_id, content, created_at)`` of a segment, oldest first. Segments never change once
+    written so decoded ones are kept in a small per-process LRU.
+    """
+    with _cache_lock:
+        rows = _cache.get(segment.pk)
+        if rows is not None:
+            _cache.move_to_end(segment.pk)
+            segment_reads_counter.inc(cache="hit")
+            return rows
+
+    segment_reads_counter.inc(cache="miss")
+    with segment.file.open("rb") as file:
+        rows = decode_segment(file.read())
+
+    with _cache_lock:
+        _cache[segment.pk] = rows
+        while len(_cache) > settings.CHAT_ARCHIVE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return rows
+
+
+def archive_batch(cutoff, batch_size=None):
+    """
+    Move the oldest ``batch_size`` messages created before ``cutoff`` into one new segment per chat.
+
+    Messages are always taken in ``(created_at, id)`` order, so the archived messages of a chat are older than
+    every message still in the table. Returns the number of archived messages.
+    """
+    if batch_size is None:
+        batch_size = settings.CHAT_ARCHIVE_BATCH_SIZE
+
+    with transaction.atomic():
+        rows = list(
+            ChatHistory.objects.select_for_update().filter(created_at__lt=cutoff).order_by("created_at", "id")
+            .values_list("id", "chat_id", "sender_id", "content", "created_at", "received_at")[:batch_size]
+        )
+
+        chats = {}
+        for pk, chat_id, sender_id, content, created_at, received_at in rows:
+            chats.setdefault(chat_id, []).append((pk, sender_id, content, created_at, received_at))
+
+        for chat_id, chat_rows in chats.items():
+            first, last = chat_rows[0], chat_rows[-1]
+            segment = ArchiveSegment(
+                chat_id=chat_id,
+                count=len(chat_rows),
+                first_id=first[0],
+                last_id=last[0],
+                first_created_at=first[3],
+                last_created_at=last[3]
+            )
+            name = "{}-{}-{}.jsonl.gz".format(chat_id, first[0], last[0])
+            segment.file.save(name, ContentFile(encode_segment(chat_rows)), save=False)
+            segment.save()
+
+        ChatHistory.objects.filter(id__in=[row[0] for row in rows]).delete()
+
+    archived_counter.inc(len(rows))
+    return len(rows)
+
+
+def get_archived_rows(chat_id, key=None, ascending=False, limit=None):
+    """
+    Archived rows of a chat strictly after (``ascending``) or before ``key``, a ``(created_at, id)`` pair,
+    in the requested order. Only the segments needed to return ``limit`` rows are read.
+    """
+    segments = ArchiveSegment.objects.filter(chat=chat_id)
+    if ascending:
+        if key is not None:
+            segments = segments.filter(last_created_at__gte=key[0])
+        segments = segments.order_by("first_created_at", "first_id")
+    else:
+        if key is not None:
+            segments = segments.filter(first_created_at__lte=key[0])
+        segments = segments.order_by("-last_created_at", "-last_id")
+
+    result = []
+    for segment in segments:
+        rows = read_segment(segment)
+        if not ascending:
+            rows = rows[::-1]
+        if key is not None:
+            rows = [row for row in rows if ((row[3], row[0]) > key if ascending else (row[3], row[0]) < key)]
+        result.extend(rows)
+        if limit is not None and len(result) >= limit:
+            return result[:limit]
+    return result
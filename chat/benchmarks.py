@@ -0,0 +1,370 @@
+import asyncio
+import contextlib
+import datetime
+import json
+import random
+import subprocess
+import time
+import timeit
+import uuid
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from rest_framework.authtoken.models import Token
+
+from chat import codecs, search
+from chat.consumers import ChatConsumer
+from chat.models import Chat, ChatHistory
+from lbdev_chat.layers import ShardedRedisChannelLayer
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(values, scale=1000):
+    """
+    Latency summary in milliseconds for a list of durations in seconds.
+    """
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50) * scale if values else None,
+        "p99": percentile(values, 0.99) * scale if values else None,
+        "max": max(values) * scale if values else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(report, output=None):
+    report = dict(report, commit=git_commit(), created_at=datetime.datetime.utcnow().isoformat())
+    data = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(data)
+    return data
+
+
+def unique_prefix(name):
+    """
+    Username prefix of the fixtures of one run, so runs against the same database do not collide.
+    """
+    return "{}-{}-".format(name, int(time.time() * 1000))
+
+
+@contextlib.contextmanager
+def throwaway_database():
+    """
+    Point the default connection at a fresh test database for the block and destroy it afterwards.
+    """
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+class SimulatedClient:
+    """
+    A websocket client driving ChatConsumer through the authorization -> get_contacts -> message flow.
+    """
+
+    def __init__(self, application, token, sent_at, latencies):
+        self.communicator = WebsocketCommunicator(application, "/chat")
+        self.token = token
+        self.sent_at = sent_at
+        self.latencies = latencies
+        self.received = 0
+        self.chat = None
+        self._waiters = {}
+        self._reader = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError("Connection refused")
+        await self.communicator.receive_json_from(timeout=30)
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        while True:
+            content = await self.communicator.receive_json_from(timeout=3600)
+            if content["type"] == "message" and content["data"]["data"]["direction"] == "received":
+                sent_at = self.sent_at.pop(content["data"]["data"]["content"], None)
+                if sent_at is not None:
+                    self.latencies.append(time.perf_counter() - sent_at)
+                self.received += 1
+            waiter = self._waiters.pop(content["type"], None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(content["data"])
+
+    async def request(self, route, data):
+        waiter = self._waiters[route + "_response"] = asyncio.get_running_loop().create_future()
+        await self.communicator.send_json_to({"type": route, "data": data})
+        return await asyncio.wait_for(waiter, 30)
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.communicator.disconnect()
+
+
+@database_sync_to_async
+def create_fixtures(clients):
+    """
+    Create ``clients`` users with tokens, paired two by two in direct chats.
+    """
+    prefix = unique_prefix("bench")
+    users = User.objects.bulk_create([
+        User(username="{}{}".format(prefix, index), first_name="Bench", last_name=str(index))
+        for index in range(clients)
+    ])
+    users = list(User.objects.filter(username__startswith=prefix).order_by("id"))
+    tokens = Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in users])
+
+    chats = []
+    for index in range(0, clients - 1, 2):
+        chat, created = Chat.objects.get_or_create_direct(users[index].id, users[index + 1].id)
+        chats.extend([chat, chat])
+    return [token.key for token in tokens], chats
+
+
+async def run_benchmark(clients=100, messages=10, timeout=60):
+    if clients < 2:
+        raise ValueError("At least two clients are needed")
+
+    tokens, chats = await create_fixtures(clients)
+    application = ChatConsumer.as_asgi()
+    sent_at = {}
+    latencies = []
+    simulated = [SimulatedClient(application, token, sent_at, latencies) for token in tokens[:len(chats)]]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client.connect() for client in simulated))
+    await asyncio.gather(*(client.request("authorization", {"token": client.token}) for client in simulated))
+    connect_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    contacts = await asyncio.gather(*(client.request("get_contacts", {}) for client in simulated))
+    contacts_seconds = time.perf_counter() - start
+    for client, client_contacts in zip(simulated, contacts):
+        client.chat = client_contacts[0]["pk"]
+
+    async def send_messages(index, client):
+        for sequence in range(messages):
+            content = "{}:{}".format(index, sequence)
+            sent_at[content] = time.perf_counter()
+            await client.request("message", {"to": client.chat, "content": content})
+
+    expected = len(simulated) * messages
+    start = time.perf_counter()
+    await asyncio.gather(*(send_messages(index, client) for index, client in enumerate(simulated)))
+    deadline = time.perf_counter() + timeout
+    while sum(client.received for client in simulated) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    message_seconds = time.perf_counter() - start
+    delivered = sum(client.received for client in simulated)
+
+    await asyncio.gather(*(client.close() for client in simulated))
+
+    return {
+        "clients": len(simulated),
+        "messages_per_client": messages,
+        "channel_layer": settings.CHANNEL_LAYERS["default"]["BACKEND"],
+        "database": connection.vendor,
+        "connect": {
+            "seconds": connect_seconds,
+            "rate": len(simulated) / connect_seconds,
+        },
+        "get_contacts": {
+            "seconds": contacts_seconds,
+            "rate": len(simulated) / contacts_seconds,
+        },
+        "messages": {
+            "sent": expected,
+            "delivered": delivered,
+            "seconds": message_seconds,
+            "throughput": delivered / message_seconds,
+        },
+        "fanout_latency_ms": summarize(latencies),
+    }
+
+
+def sample_payloads(contacts=50):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return {
+        "message": {
+            "type": "message",
+            "data": {
+                "pk": str(uuid.uuid4()),
+                "data": {
+                    "id": 123456789,
+                    "direction": "received",
+                    "content": "Hey, are we still meeting tomorrow at 10?",
+                    "time": now.isoformat()
+                }
+            }
+        },
+        "get_history_response": {
+            "type": "get_history_response",
+            "data": {
+                "pk": str(uuid.uuid4()),
+                "messages": [
+                    {"id": 123456789 + index, "direction": "send", "content": "Message {}".format(index), "time": now}
+                    for index in range(contacts)
+                ],
+                "before": None,
+                "after": None
+            }
+        },
+        "get_contacts_response": {
+            "type": "get_contacts_response",
+            "data": [
+                {"pk": str(uuid.uuid4()), "name": "Contact {}".format(index), "online": index % 2 == 0}
+                for index in range(contacts)
+            ]
+        },
+    }
+
+
+def run_codec_benchmark(iterations=10000, contacts=50):
+    """
+    Encode/decode cost (microseconds per operation) and frame size of every codec for typical payloads.
+    """
+    results = {}
+    for payload_name, payload in sample_payloads(contacts).items():
+        for subprotocol, codec in codecs.CODECS.items():
+            encoded = codec.encode(payload)
+            encode_seconds = timeit.timeit(lambda: codec.encode(payload), number=iterations)
+            decode_seconds = timeit.timeit(lambda: codec.decode(encoded), number=iterations)
+            results.setdefault(payload_name, {})[subprotocol] = {
+                "bytes": len(encoded.encode() if isinstance(encoded, str) else encoded),
+                "encode_us": encode_seconds / iterations * 1e6,
+                "decode_us": decode_seconds / iterations * 1e6,
+            }
+    return {
+        "iterations": iterations,
+        "contacts": contacts,
+        "payloads": results,
+    }
+
+
+def create_corpus(messages, users=100, vocabulary=50000, batch_size=10000):
+    """
+    ``messages`` synthetic ChatHistory rows spread over direct chats, words drawn with a Zipf-like distribution.
+    """
+    prefix = unique_prefix("search")
+    User.objects.bulk_create([User(username="{}{}".format(prefix, index)) for index in range(users)])
+    users = list(User.objects.filter(username__startswith=prefix).order_by("id"))
+    chats = [
+        (Chat.objects.get_or_create_direct(users[index].id, users[index + 1].id)[0], users[index], users[index + 1])
+        for index in range(0, len(users) - 1, 2)
+    ]
+
+    words = ["w{}".format(index) for index in range(vocabulary)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary)]
+    for start in range(0, messages, batch_size):
+        rows = []
+        for _ in range(min(batch_size, messages - start)):
+            chat, user, contact = random.choice(chats)
+            content = " ".join(random.choices(words, weights, k=random.randint(5, 20)))
+            rows.append(ChatHistory(chat=chat, sender=random.choice((user, contact)), content=content))
+        ChatHistory.objects.bulk_create(rows, batch_size=1000)
+    return users, words
+
+
+def run_search_benchmark(messages=1000000, queries=200, limit=20):
+    """
+    Index build time and ``search_messages`` latency against a ``content__icontains`` scan on a synthetic corpus.
+    """
+    started_at = time.perf_counter()
+    users, words = create_corpus(messages)
+    corpus_seconds = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    search.rebuild()
+    rebuild_seconds = time.perf_counter() - started_at
+
+    indexed, scanned = [], []
+    for _ in range(queries):
+        user = random.choice(users)
+        # Mix frequent and rare words, as real queries do.
+        query = " ".join(random.choice(words[:100] if random.random() < 0.5 else words) for _ in range(2))
+
+        started_at = time.perf_counter()
+        search.search_messages(user.id, query, limit=limit)
+        indexed.append(time.perf_counter() - started_at)
+
+        started_at = time.perf_counter()
+        list(ChatHistory.objects.filter(chat__members=user, content__icontains=query.split()[0])[:limit])
+        scanned.append(time.perf_counter() - started_at)
+
+    return {
+        "messages": messages,
+        "queries": queries,
+        "corpus_seconds": corpus_seconds,
+        "rebuild_seconds": rebuild_seconds,
+        "search_latency_ms": summarize(indexed),
+        "icontains_latency_ms": summarize(scanned),
+    }
+
+
+async def run_channel_layer_benchmark(hosts, workers=8, groups=1000, messages=10000, timeout=60):
+    """
+    group_send throughput of a ShardedRedisChannelLayer over ``hosts``, with ``workers`` layers standing for the
+    worker processes that own the ``groups`` member channels.
+    """
+    config = {"hosts": hosts, "prefix": "bench{}:".format(int(time.time() * 1000)), "capacity": messages}
+    layers = [ShardedRedisChannelLayer(**config) for _ in range(workers)]
+    sender = ShardedRedisChannelLayer(**config)
+    members = []
+    for index in range(groups):
+        layer = layers[index % workers]
+        channel = await layer.new_channel()
+        await layer.group_add("bench.{}".format(index), channel)
+        members.append((layer, channel, len(range(index, messages, groups))))
+
+    async def drain(layer, channel, expected):
+        for _ in range(expected):
+            await layer.receive(channel)
+
+    slots = asyncio.Semaphore(100)
+
+    async def send(index):
+        async with slots:
+            await sender.group_send("bench.{}".format(index % groups), {"type": "bench", "index": index})
+
+    try:
+        started_at = time.perf_counter()
+        receiving = asyncio.gather(*(drain(*member) for member in members))
+        await asyncio.gather(*(send(index) for index in range(messages)))
+        sent_at = time.perf_counter()
+        await asyncio.wait_for(receiving, timeout)
+        finished_at = time.perf_counter()
+    finally:
+        await sender.flush()
+        for layer in layers + [sender]:
+            await layer.close_pools()
+
+    return {
+        "shards": len(hosts),
+        "workers": workers,
+        "groups": groups,
+        "messages": messages,
+        "sends_per_second": messages / (sent_at - started_at),
+        "deliveries_per_second": messages / (finished_at - started_at),
+    }
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from chat import fanout, search, snapshots
+from chat.db import database_sync_to_async
+from chat.models import Chat, ChatHistory
+from lbdev_chat import metrics
+
+logger = logging.getLogger(__name__)
+
+batch_size_histogram = metrics.histogram(
+    "chat_write_buffer_batch_size",
+    "Number of ChatHistory rows written per write-behind flush."
+)
+flush_errors_counter = metrics.counter(
+    "chat_write_buffer_flush_errors_total",
+    "Write-behind flushes that failed to commit."
+)
+
+
+class ChatHistoryBuffer:
+    """
+    Per-process write-behind queue for ChatHistory rows.
+
+    Rows are collected for ``window`` milliseconds or until ``batch_size`` rows are pending and then written
+    with a single ``bulk_create``. Each ``add`` call only returns once the batch holding its row is committed.
+    The chats of the rows are checked by the batch too, a row of a missing chat raises ``Chat.DoesNotExist``.
+    When the batch fails to commit its rows are written one by one, so only the sender of a bad row gets the error.
+    """
+
+    def __init__(self, window=None, batch_size=None):
+        self._window = window
+        self._batch_size = batch_size
+        self._pending = []
+        self._timer = None
+
+    @property
+    def window(self):
+        if self._window is None:
+            return settings.CHAT_WRITE_BUFFER_WINDOW_MS
+        return self._window
+
+    @property
+    def batch_size(self):
+        if self._batch_size is None:
+            return settings.CHAT_WRITE_BUFFER_SIZE
+        return self._batch_size
+
+    async def add(self, chat_history):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((chat_history, future))
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window / 1000, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            fanout.watch(asyncio.ensure_future(self._flush(batch)), flush_errors_counter, "write-behind flush")
+
+    async def _flush(self, batch):
+        batch_size_histogram.observe(len(batch))
+        try:
+            errors = await self.write([chat_history for chat_history, future in batch])
+        except Exception as exc:
+            flush_errors_counter.inc()
+            for chat_history, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for (chat_history, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(chat_history)
+                else:
+                    future.set_exception(error)
+
+    @classmethod
+    @database_sync_to_async
+    def write(cls, chat_histories):
+        """
+        Write the rows and return the error of each one, ``None`` for the rows that were committed.
+        """
+        chat_ids = set(
+            Chat.objects.filter(pk__in={chat_history.chat_id for chat_history in chat_histories})
+            .values_list("pk", flat=True)
+        )
+        errors = [None if chat_history.chat_id in chat_ids else Chat.DoesNotExist() for chat_history in chat_histories]
+        rows = [chat_history for chat_history, error in zip(chat_histories, errors) if error is None]
+        if not rows:
+            return errors
+
+        try:
+            cls._write(rows)
+        except Exception:
+            flush_errors_counter.inc()
+            logger.warning("write-behind batch failed, writing its %d rows one by one", len(rows), exc_info=True)
+            for index, chat_history in enumerate(chat_histories):
+                if errors[index] is not None:
+                    continue
+                try:
+                    cls._write([chat_history])
+                except Exception as exc:
+                    errors[index] = exc
+        return errors
+
+    @staticmethod
+    def _write(chat_histories):
+        try:
+            with transaction.atomic():
+                if connection.features.can_return_rows_from_bulk_insert:
+                    ChatHistory.objects.bulk_create(chat_histories)
+                    search.index_messages(chat_histories)
+                    snapshots.record_messages(chat_histories)
+                else:
+                    # Without RETURNING the primary keys would be lost, keep the single transaction instead.
+                    for chat_history in chat_histories:
+                        chat_history.save(fanout=False)
+                transaction.on_commit(lambda: fanout.dispatch_many(chat_histories))
+        except Exception:
+            # The rollback dropped the rows, forget the keys they were given so they can be written again.
+            for chat_history in chat_histories:
+                chat_history.pk = None
+                chat_history._state.adding = True
+            raise
+
+history_buffer = ChatHistoryBuffer()
@@ -0,0 +1,89 @@
+import datetime
+import json
+import uuid
+
+import msgpack
+
+UUID_EXT_TYPE = 1
+
+
+class JsonCodec:
+    """
+    Default codec, JSON text frames.
+    """
+    subprotocol = "lbdev-chat.json"
+    binary = False
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        if isinstance(value, uuid.UUID):
+            return str(value)
+        raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+    def encode(self, content):
+        return json.dumps(content, default=self._default)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def encode_batch(self, encoded_events):
+        """
+        ``{"type": "batch", "data": [...]}`` frame out of already encoded events.
+        """
+        return '{"type": "batch", "data": [' + ", ".join(encoded_events) + ']}'
+
+
+class MessagePackCodec:
+    """
+    MessagePack binary frames. Datetimes travel as the MessagePack timestamp extension and UUIDs as their
+    16 raw bytes in extension type 1.
+    """
+    subprotocol = "lbdev-chat.msgpack"
+    binary = True
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, uuid.UUID):
+            return msgpack.ExtType(UUID_EXT_TYPE, value.bytes)
+        if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+            return value.isoformat()
+        raise TypeError("Object of type {} is not MessagePack serializable".format(type(value).__name__))
+
+    @staticmethod
+    def _ext_hook(code, data):
+        if code == UUID_EXT_TYPE:
+            return str(uuid.UUID(bytes=data))
+        return msgpack.ExtType(code, data)
+
+    def encode(self, content):
+        return msgpack.packb(content, default=self._default, datetime=True, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, ext_hook=self._ext_hook, timestamp=3, raw=False)
+
+    def encode_batch(self, encoded_events):
+        """
+        ``{"type": "batch", "data": [...]}`` frame out of already encoded events, only the header is packed here.
+        """
+        header = msgpack.Packer()
+        return b"".join([
+            header.pack_map_header(2), header.pack("type"), header.pack("batch"), header.pack("data"),
+            header.pack_array_header(len(encoded_events)), *encoded_events
+        ])
+
+DEFAULT_CODEC = JsonCodec()
+CODECS = {codec.subprotocol: codec for codec in (DEFAULT_CODEC, MessagePackCodec())}
+
+
+def negotiate(subprotocols):
+    """
+    Pick the codec of the first subprotocol offered by the client that is supported.
+
+    Returns the codec and the subprotocol to accept, ``None`` when the client did not ask for one.
+    """
+    for subprotocol in subprotocols or ():
+        if subprotocol in CODECS:
+            return CODECS[subprotocol], subprotocol
+    return DEFAULT_CODEC, None
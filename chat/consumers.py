@@ -1,11 +1,20 @@
 import asyncio
 import json
-from threading import Timer
+import logging
+import random
 
-from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
 
+from chat import codecs
+from chat.local import local_registry
 from chat.managers import ChatManager
+from chat.outbound import OutboundBatcher, OutboundQueue
+from lbdev_chat import metrics
+
+logger = logging.getLogger(__name__)
+
+open_sockets_gauge = metrics.gauge("chat_open_sockets", "Websocket connections open in this process.")
 
 
 class ChatConsumer(AsyncJsonWebsocketConsumer):
@@ -14,6 +23,13 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         self.room_name = ''
         self.room_group_name = ''
         self._timeout = None
+        self._timeout_task = None
+        self._group_refresh = None
+        self._group_refresh_task = None
+        self.codec = codecs.DEFAULT_CODEC
+        self._batcher = None
+        self._outbound = OutboundQueue(self)
+        self._accepted = False
         self._manager = ChatManager(self)
 
     async def set_group(self):
@@ -22,13 +38,43 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             self.room_name,
             self.channel_name
         )
+        local_registry.add(self.room_name, self._manager.user.id, self)
+        self._schedule_group_refresh()
+
+    def _schedule_group_refresh(self):
+        # Jittered so the sockets of a worker do not all re-add at once.
+        self._group_refresh = asyncio.get_running_loop().call_later(
+            settings.CHAT_GROUP_REFRESH_SECONDS * random.uniform(0.5, 1), self._on_group_refresh
+        )
+
+    def _on_group_refresh(self):
+        self._group_refresh = None
+        self._group_refresh_task = asyncio.ensure_future(self._refresh_group())
+
+    async def _refresh_group(self):
+        if not self._accepted:
+            return
+        # Re-adding is idempotent and restores the membership when the redis shard holding the group restarted.
+        try:
+            await self.channel_layer.group_add(self.room_name, self.channel_name)
+        except Exception:
+            logger.warning("group refresh failed group=%s", self.room_name, exc_info=True)
+        if self._accepted:
+            self._schedule_group_refresh()
 
     async def connect(self):
-        await self.accept()
+        self.codec, subprotocol = codecs.negotiate(self.scope.get("subprotocols"))
+        await self.accept(subprotocol=subprotocol)
+        self._accepted = True
+        open_sockets_gauge.inc()
         await self.send_response("info", "Waiting user token...")
 
-        self._timeout = Timer(5.0, lambda: asyncio.run(self._timeout_connection()))
-        self._timeout.start()
+        # A timer handle on the consumer's own loop, no thread is needed per pending handshake.
+        self._timeout = asyncio.get_running_loop().call_later(settings.CHAT_AUTH_TIMEOUT, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timeout = None
+        self._timeout_task = asyncio.ensure_future(self._timeout_connection())
 
     async def _timeout_connection(self):
         await self.send_response("authorization_response", {
@@ -48,11 +94,66 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             "data": data
         })
 
+    async def send_json(self, content, close=False):
+        if self.codec.binary:
+            await self.send(bytes_data=self.codec.encode(content), close=close)
+        else:
+            await self.send(text_data=self.codec.encode(content), close=close)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        # Text frames are always JSON, binary frames use the negotiated codec.
+        if text_data is not None:
+            await self.receive_json(codecs.DEFAULT_CODEC.decode(text_data), **kwargs)
+        else:
+            await self.receive_json(self.codec.decode(bytes_data), **kwargs)
+
+    def enable_batching(self):
+        if self._batcher is None:
+            self._batcher = OutboundBatcher(self)
+
+    async def connections_changed(self, event):
+        local_registry.invalidate(self.room_name)
+
     async def send_message(self, data):
-        await self.send_response(data["data"]["type"], data["data"]["data"])
+        if self.channel_name in data.get("local", ()):
+            # Already delivered in memory by the publishing fan-out of this process.
+            return
+        self._outbound.put(data["data"]["type"], data["data"]["data"])
+
+    async def deliver(self, response_type: str, data):
+        if response_type == "message":
+            self._manager.seen(data["data"]["id"])
+        if self._batcher is not None:
+            await self._batcher.send(response_type, data)
+        else:
+            await self.send_response(response_type, data)
+
+    async def resync_and_close(self):
+        await self.send_response("resync", {
+            "message": "Too many pending events, reconnect and reload the chat state."
+        })
+        await self.close(code=4008)
 
     async def disconnect(self, code):
-        await sync_to_async(print)(self._manager.room_name)
+        if self.room_name:
+            local_registry.discard(self.room_name, self)
+        await self.timeout_stop()
+        if self._group_refresh is not None:
+            self._group_refresh.cancel()
+            self._group_refresh = None
+        if self._group_refresh_task is not None:
+            # A refresh in flight would add the channel back after the group_discard below.
+            self._group_refresh_task.cancel()
+            await asyncio.gather(self._group_refresh_task, return_exceptions=True)
+            self._group_refresh_task = None
+        self._outbound.close()
+        if self._batcher is not None:
+            self._batcher.close()
+        if self._accepted:
+            self._accepted = False
+            open_sockets_gauge.dec()
+        if metrics.sampled():
+            logger.debug("disconnect code=%s session=%s", code, self._manager.room_name)
         await self._manager.on_disconnect()
         if self._manager.room_name:
             await self.channel_layer.group_discard(
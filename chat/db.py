@@ -0,0 +1,115 @@
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from lbdev_chat import metrics
+
+current_route = contextvars.ContextVar("current_route", default="")
+_queued_at = contextvars.ContextVar("queued_at")
+
+queue_wait_histogram = metrics.histogram(
+    "chat_db_queue_wait_seconds",
+    "Time a database call waited for a worker thread.",
+    buckets=metrics.LATENCY_BUCKETS
+)
+db_time_histogram = metrics.histogram(
+    "chat_db_call_seconds",
+    "Time spent running a database call in its worker thread.",
+    buckets=metrics.LATENCY_BUCKETS
+)
+connect_histogram = metrics.histogram(
+    "chat_db_connect_seconds",
+    "Time to open a persistent database connection in a worker thread.",
+    buckets=metrics.LATENCY_BUCKETS
+)
+connections_created_counter = metrics.counter("chat_db_connections_created_total", "Database connections opened.")
+health_check_failures_counter = metrics.counter(
+    "chat_db_health_check_failures_total",
+    "Persistent database connections found broken and closed before a call."
+)
+
+_executor_lock = threading.Lock()
+_executor = None
+
+
+@receiver(connection_created)
+def count_connection(sender, connection, **kwargs):
+    connections_created_counter.inc(alias=connection.alias)
+
+
+def get_executor():
+    """
+    Dedicated pool of CHAT_DB_POOL_SIZE threads, each keeping its own persistent connection, or None to run
+    every call on the shared thread-sensitive thread.
+    """
+    global _executor
+    if not settings.CHAT_DB_POOL_SIZE:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.CHAT_DB_POOL_SIZE, thread_name_prefix="chat-db")
+        return _executor
+
+
+def prepare_connections():
+    """
+    Health check the persistent connections of the calling thread every CHAT_DB_HEALTH_CHECK_INTERVAL seconds
+    and open the default one ahead of the call, so broken connections are replaced before a query fails.
+    """
+    now = time.monotonic()
+    for connection in connections.all():
+        if not connection.settings_dict["CONN_MAX_AGE"] or connection.in_atomic_block:
+            continue
+        if connection.connection is None:
+            if connection.alias == "default":
+                connection.ensure_connection()
+                connect_histogram.observe(time.monotonic() - now, alias=connection.alias)
+            connection.health_checked_at = now
+        elif now - getattr(connection, "health_checked_at", 0) >= settings.CHAT_DB_HEALTH_CHECK_INTERVAL:
+            connection.health_checked_at = now
+            if not connection.is_usable():
+                health_check_failures_counter.inc(alias=connection.alias)
+                connection.close()
+
+
+class InstrumentedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """
+    DatabaseSyncToAsync that records how long each call waited for a thread and how long it ran there,
+    labelled with the function and the chat route being resolved.
+
+    When CHAT_DB_POOL_SIZE is set the calls run on the dedicated ``get_executor`` pool.
+    """
+
+    def __init__(self, func, thread_sensitive=None, executor=None):
+        @functools.wraps(func)
+        def instrumented(*func_args, **func_kwargs):
+            started_at = time.perf_counter()
+            labels = {"function": func.__qualname__, "route": current_route.get()}
+            queue_wait_histogram.observe(started_at - _queued_at.get(started_at), **labels)
+            prepare_connections()
+            try:
+                return func(*func_args, **func_kwargs)
+            finally:
+                db_time_histogram.observe(time.perf_counter() - started_at, **labels)
+
+        if thread_sensitive is None:
+            # With a pool, calls run on any of its threads instead of the single thread-sensitive one.
+            executor = executor or get_executor()
+            thread_sensitive = executor is None
+        super().__init__(instrumented, thread_sensitive=thread_sensitive, executor=executor)
+
+    async def __call__(self, *args, **kwargs):
+        # The context is copied into the worker thread, where the wait is measured.
+        _queued_at.set(time.perf_counter())
+        return await super().__call__(*args, **kwargs)
+
+
+database_sync_to_async = InstrumentedDatabaseSyncToAsync
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+import weakref
+
+from asgiref.sync import SyncToAsync, async_to_sync
+from channels.layers import get_channel_layer
+
+from chat.local import local_registry
+from lbdev_chat import metrics
+
+logger = logging.getLogger(__name__)
+
+fanout_size_histogram = metrics.histogram("chat_fanout_groups", "Groups an event fan-out publishes to.")
+deliveries_counter = metrics.counter(
+    "chat_deliveries_total",
+    "Events delivered in memory to sockets of this process (local) or published to the channel layer (remote)."
+)
+failures_counter = metrics.counter("chat_fanout_failures_total", "Fan-outs of committed events that failed to publish.")
+publish_latency_histogram = metrics.histogram(
+    "chat_channel_layer_publish_seconds",
+    "Latency of a single channel layer group_send.",
+    buckets=metrics.LATENCY_BUCKETS
+)
+
+_group_locks = weakref.WeakValueDictionary()
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def watch(future, counter, description):
+    """
+    Log and count the error of a task nobody awaits, so a failure does not go unnoticed.
+    """
+    def done(future):
+        if not future.cancelled() and future.exception() is not None:
+            counter.inc()
+            logger.error("%s failed", description, exc_info=future.exception())
+
+    future.add_done_callback(done)
+    return future
+
+
+def build_payloads(chat_history):
+    payloads = {}
+    for direction in ("send", "received"):
+        payloads[direction] = {
+            "type": "send_message",
+            "data": {
+                "type": "message",
+                "data": {
+                    "pk": str(chat_history.chat_id),
+                    "data": {
+                        "id": chat_history.pk,
+                        "direction": direction,
+                        "content": chat_history.content,
+                        "time": chat_history.created_at.isoformat()
+                    }
+                }
+            }
+        }
+    return payloads
+
+
+def get_recipients(chat_ids):
+    """
+    Map every chat to the delivery groups of its members, one group per user whatever their device count.
+    """
+    from chat.models import Chat, user_group
+
+    recipients = {}
+    members = Chat.members.through.objects.filter(chat__in=chat_ids).values_list("chat_id", "user_id")
+    for chat_id, user_id in members:
+        recipients.setdefault(chat_id, []).append((user_group(user_id), user_id))
+    return recipients
+
+
+def build_events(chat_histories):
+    """
+    Map every recipient group to the ordered list of events it has to receive.
+    """
+    recipients = get_recipients({chat_history.chat_id for chat_history in chat_histories})
+    events = {}
+    for chat_history in chat_histories:
+        payloads = build_payloads(chat_history)
+        for group, user_id in recipients.get(chat_history.chat_id, ()):
+            direction = "send" if user_id == chat_history.sender_id else "received"
+            events.setdefault(group, []).append(payloads[direction])
+    return events
+
+
+async def _publish_group(channel_layer, group, messages):
+    # Publishes to the same group are serialized so concurrent fan-outs keep the commit order.
+    lock = _group_locks.get(group)
+    if lock is None:
+        lock = _group_locks[group] = asyncio.Lock()
+    async with lock:
+        for message in messages:
+            local = local_registry.consumers(group)
+            if local:
+                for consumer in local:
+                    await consumer.send_message(message)
+                deliveries_counter.inc(len(local), path="local")
+                # Every connection of the user is in this process, the channel layer has nobody else to reach.
+                if not await local_registry.has_remote(group, len(local)):
+                    continue
+                # The layer brings the message back to the local sockets too, they skip it.
+                message = dict(message, local=[consumer.channel_name for consumer in local])
+
+            started_at = time.perf_counter()
+            await channel_layer.group_send(group, message)
+            publish_latency_histogram.observe(time.perf_counter() - started_at)
+            deliveries_counter.inc(path="remote")
+
+
+async def publish(events):
+    fanout_size_histogram.observe(len(events))
+    channel_layer = get_channel_layer()
+    await asyncio.gather(*(
+        _publish_group(channel_layer, group, messages) for group, messages in events.items()
+    ))
+
+
+def dispatch_many(chat_histories):
+    """
+    Fan committed ChatHistory rows out to every member of their chats.
+
+    The recipients are resolved in the calling (database) thread, the publishing itself is scheduled
+    on the event loop so the caller does not wait for the channel layer.
+    """
+    events = build_events(chat_histories)
+    if not events:
+        return
+
+    if _running_loop() is not None:
+        watch(asyncio.ensure_future(publish(events)), failures_counter, "fan-out")
+        return
+
+    # Called from a worker thread started by sync_to_async, publish on the loop that is waiting on it.
+    loop = getattr(SyncToAsync.threadlocal, "main_event_loop", None)
+    if loop is not None and loop.is_running():
+        watch(asyncio.run_coroutine_threadsafe(publish(events), loop), failures_counter, "fan-out")
+        return
+
+    try:
+        async_to_sync(publish)(events)
+    except Exception:
+        # The rows are committed already, the caller must not see the write as failed.
+        failures_counter.inc()
+        logger.exception("fan-out failed")
+
+
+def dispatch(chat_history):
+    dispatch_many([chat_history])
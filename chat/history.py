@@ -0,0 +1,132 @@
+import base64
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from chat import archive
+from chat.models import ChatHistory
+
+BEFORE = "before"
+AFTER = "after"
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(created_at, pk):
+    value = "{}|{}".format(created_at.isoformat(), pk)
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        created_at, pk = datetime.datetime.fromisoformat(created_at), int(pk)
+    except (AttributeError, ValueError, UnicodeDecodeError) as exc:
+        raise CursorError("Invalid cursor") from exc
+    # Encoded cursors are aware, a naive one could not be compared with the archive segment bounds.
+    if settings.USE_TZ and timezone.is_naive(created_at):
+        raise CursorError("Invalid cursor")
+    return created_at, pk
+
+
+def get_page_size(limit):
+    if limit is None:
+        return settings.CHAT_HISTORY_PAGE_SIZE
+    return max(1, min(int(limit), settings.CHAT_HISTORY_MAX_PAGE_SIZE))
+
+
+def get_history_page(chat_id, user_id, cursor=None, direction=BEFORE, limit=None):
+    """
+    Keyset pagination over ``(created_at, id)`` of a chat.
+
+    ``before`` pages walk back to older messages, ``after`` pages walk forward to newer ones; without a cursor
+    the newest page is returned. Messages are always returned oldest first, archived ones included.
+    """
+    limit = get_page_size(limit)
+    queryset = ChatHistory.objects.filter(chat=chat_id)
+    key = None
+
+    if cursor is not None:
+        created_at, pk = decode_cursor(cursor)
+        key = (created_at, pk)
+        if direction == AFTER:
+            queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk),
+                                       created_at__gte=created_at)
+        else:
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk),
+                                       created_at__lte=created_at)
+
+    if direction == AFTER:
+        queryset = queryset.order_by("created_at", "id")
+    else:
+        queryset = queryset.order_by("-created_at", "-id")
+
+    # Archived messages are older than every message in the table: they come first walking forward and only
+    # once the table is exhausted walking back.
+    if direction == AFTER:
+        rows = archive.get_archived_rows(chat_id, key, ascending=True, limit=limit + 1)
+        if len(rows) <= limit:
+            rows += list(queryset.values_list("id", "sender_id", "content", "created_at")[:limit + 1 - len(rows)])
+    else:
+        rows = list(queryset.values_list("id", "sender_id", "content", "created_at")[:limit + 1])
+        if len(rows) <= limit:
+            rows += archive.get_archived_rows(chat_id, key, limit=limit + 1 - len(rows))
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction != AFTER:
+        rows.reverse()
+
+    messages = [
+        {
+            "id": pk,
+            "direction": "send" if sender_id == user_id else "received",
+            "content": content,
+            "time": created_at
+        } for pk, sender_id, content, created_at in rows
+    ]
+
+    before = after = None
+    if rows:
+        oldest, newest = rows[0], rows[-1]
+        if direction == AFTER:
+            before = encode_cursor(oldest[3], oldest[0])
+            after = encode_cursor(newest[3], newest[0]) if has_more else None
+        else:
+            before = encode_cursor(oldest[3], oldest[0]) if has_more else None
+            after = encode_cursor(newest[3], newest[0]) if cursor is not None else None
+
+    return {
+        "pk": str(chat_id),
+        "messages": messages,
+        "before": before,
+        "after": after
+    }
+
+
+def get_unseen(user_id, since_id, limit=None):
+    """
+    Messages of every chat of the user with an id above ``since_id``, oldest first.
+    """
+    limit = get_page_size(limit)
+    rows = list(
+        ChatHistory.objects.filter(chat__members=user_id, id__gt=since_id).order_by("id")
+        .values_list("id", "chat_id", "sender_id", "content", "created_at")[:limit + 1]
+    )
+
+    return {
+        "messages": [
+            {
+                "pk": str(chat_id),
+                "id": pk,
+                "direction": "send" if sender_id == user_id else "received",
+                "content": content,
+                "time": created_at
+            } for pk, chat_id, sender_id, content, created_at in rows[:limit]
+        ],
+        "more": len(rows) > limit
+    }
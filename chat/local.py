@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+from chat import presence
+from lbdev_chat import metrics
+
+presence_lookups_counter = metrics.counter(
+    "chat_local_presence_lookups_total",
+    "Shared presence counts read by the local delivery fast path, the others are answered by its cache."
+)
+
+
+class LocalRegistry:
+    """
+    Delivery groups of the sockets connected to this process, so fan-out can hand them events in memory.
+
+    Entries keep the loop of their consumer: only publishers running on that same loop may deliver directly.
+    """
+
+    def __init__(self):
+        self._groups = {}
+        self._users = {}
+        self._presence = {}
+        self._generation = 0
+
+    def add(self, group, user_id, consumer):
+        self._groups.setdefault(group, {})[consumer.channel_name] = (consumer, asyncio.get_running_loop())
+        self._users[group] = user_id
+        self.invalidate(group)
+
+    def discard(self, group, consumer):
+        consumers = self._groups.get(group)
+        if consumers is None:
+            return
+        consumers.pop(consumer.channel_name, None)
+        if not consumers:
+            del self._groups[group]
+            self._users.pop(group, None)
+        self.invalidate(group)
+
+    def consumers(self, group):
+        loop = asyncio.get_running_loop()
+        return [consumer for consumer, consumer_loop in self._groups.get(group, {}).values() if consumer_loop is loop]
+
+    def invalidate(self, group):
+        self._generation += 1
+        self._presence.pop(group, None)
+
+    async def has_remote(self, group, local_count):
+        """
+        Whether the user of ``group`` has more than ``local_count`` connections, some this loop cannot serve.
+
+        The shared presence count is cached until a connection of the user opens or closes, in this process or
+        another one (see ``presence.user_connected``), or for CHAT_PRESENCE_CACHE_SECONDS at most.
+        """
+        now = time.monotonic()
+        entry = self._presence.get(group)
+        if entry is None or entry[0] < now:
+            generation = self._generation
+            presence_lookups_counter.inc()
+            count = await presence.get_presence().count(self._users.get(group))
+            # A connection that opened or closed during the lookup makes the count stale already.
+            entry = (now + settings.CHAT_PRESENCE_CACHE_SECONDS, count)
+            if generation == self._generation:
+                self._presence[group] = entry
+        return entry[1] > local_count
+
+
+local_registry = LocalRegistry()
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.archive import archive_batch, get_cutoff
+
+
+class Command(BaseCommand):
+    help = "Move messages older than CHAT_ARCHIVE_AFTER_DAYS into compressed archive segments, batch by batch."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, help="Archive messages older than this many days.")
+        parser.add_argument("--batch-size", type=int, help="Messages archived per transaction.")
+        parser.add_argument("--max-batches", type=int, help="Stop after this many batches.")
+        parser.add_argument("--sleep", type=float, default=0, help="Seconds to wait between batches.")
+
+    def handle(self, *args, **options):
+        cutoff = get_cutoff(options["days"])
+        batches = total = 0
+        while options["max_batches"] is None or batches < options["max_batches"]:
+            archived = archive_batch(cutoff, options["batch_size"])
+            if not archived:
+                break
+            batches += 1
+            total += archived
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        self.stdout.write("Archived {} messages in {} batches".format(total, batches))
@@ -0,0 +1,63 @@
+import socket
+import subprocess
+import time
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmarks import run_channel_layer_benchmark, write_report
+
+
+class Command(BaseCommand):
+    help = "Compare group_send throughput of the sharded channel layer on one redis and on all of them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--redis", nargs="*", default=[], help="Redis URLs to shard over.")
+        parser.add_argument("--spawn", type=int, default=0, help="Start this many local redis-server processes.")
+        parser.add_argument("--port", type=int, default=6400, help="First port of the spawned redis servers.")
+        parser.add_argument("--workers", type=int, default=8, help="Simulated worker processes owning the groups.")
+        parser.add_argument("--groups", type=int, default=1000, help="Groups, one member channel each.")
+        parser.add_argument("--messages", type=int, default=10000, help="group_send calls per run.")
+        parser.add_argument("--output", help="File the JSON report is written to.")
+
+    def handle(self, *args, **options):
+        processes = []
+        hosts = list(options["redis"])
+        try:
+            for port in range(options["port"], options["port"] + options["spawn"]):
+                processes.append(self.spawn_redis(port))
+                hosts.append("redis://127.0.0.1:{}".format(port))
+            if not hosts:
+                raise CommandError("Give --redis URLs or --spawn a number of local redis servers.")
+
+            runs = [
+                async_to_sync(run_channel_layer_benchmark)(
+                    shards, options["workers"], options["groups"], options["messages"]
+                ) for shards in ([hosts[:1], hosts] if len(hosts) > 1 else [hosts])
+            ]
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+        self.stdout.write(write_report({"runs": runs}, options["output"]))
+
+    @staticmethod
+    def spawn_redis(port):
+        try:
+            process = subprocess.Popen(
+                ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                stdout=subprocess.DEVNULL
+            )
+        except OSError as exc:
+            raise CommandError("redis-server could not be started: {}".format(exc))
+
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                return process
+            except OSError:
+                time.sleep(0.05)
+        process.terminate()
+        raise CommandError("redis-server did not listen on port {}".format(port))
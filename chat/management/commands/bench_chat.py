@@ -0,0 +1,28 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from chat.benchmarks import run_benchmark, throwaway_database, write_report
+
+
+class Command(BaseCommand):
+    help = "Run the websocket load benchmark against a throwaway test database and print a JSON report."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=100, help="Number of simulated websocket clients.")
+        parser.add_argument("--messages", type=int, default=10, help="Messages sent by every client.")
+        parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for pending deliveries.")
+        parser.add_argument("--redis", help="Redis URL to use as channel layer instead of the in-memory one.")
+        parser.add_argument("--output", help="File the JSON report is written to.")
+
+    def handle(self, *args, **options):
+        if options["redis"]:
+            layer = {"BACKEND": "channels_redis.core.RedisChannelLayer", "CONFIG": {"hosts": [options["redis"]]}}
+        else:
+            layer = {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+
+        with throwaway_database():
+            with override_settings(CHANNEL_LAYERS={"default": layer}, CHAT_RATE_LIMITS={}):
+                report = async_to_sync(run_benchmark)(options["clients"], options["messages"], options["timeout"])
+
+        self.stdout.write(write_report(report, options["output"]))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from chat.benchmarks import run_codec_benchmark, write_report
+
+
+class Command(BaseCommand):
+    help = "Compare encode/decode cost and frame size of the websocket codecs and print a JSON report."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=10000, help="Encode/decode calls per measurement.")
+        parser.add_argument("--contacts", type=int, default=50, help="Items in the list payloads.")
+        parser.add_argument("--output", help="File the JSON report is written to.")
+
+    def handle(self, *args, **options):
+        report = run_codec_benchmark(options["iterations"], options["contacts"])
+        self.stdout.write(write_report(report, options["output"]))
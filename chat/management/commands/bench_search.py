@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from chat.benchmarks import run_search_benchmark, throwaway_database, write_report
+
+
+class Command(BaseCommand):
+    help = "Build a synthetic corpus in a throwaway test database and compare search_messages to a scan."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000000, help="Messages in the synthetic corpus.")
+        parser.add_argument("--queries", type=int, default=200, help="Searches to time.")
+        parser.add_argument("--output", help="File the JSON report is written to.")
+
+    def handle(self, *args, **options):
+        with throwaway_database():
+            report = run_search_benchmark(options["messages"], options["queries"])
+
+        self.stdout.write(write_report(report, options["output"]))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the search_messages inverted index from every stored message."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Messages indexed per transaction.")
+
+    def handle(self, *args, **options):
+        total = search.rebuild(options["batch_size"])
+        self.stdout.write("Indexed {} messages".format(total))
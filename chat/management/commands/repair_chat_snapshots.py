@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from chat import snapshots
+from chat.models import Chat
+
+
+class Command(BaseCommand):
+    help = "Recompute the last message snapshot and the unread counters of every chat from its messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument("chats", nargs="*", help="Only repair these chat ids.")
+
+    def handle(self, *args, **options):
+        chats = Chat.objects.all()
+        if options["chats"]:
+            chats = chats.filter(pk__in=options["chats"])
+
+        total = 0
+        for chat in chats.iterator():
+            snapshots.repair(chat)
+            total += 1
+        self.stdout.write("Repaired {} chats".format(total))
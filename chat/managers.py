@@ -1,17 +1,37 @@
-from asgiref.sync import sync_to_async
-from channels.db import database_sync_to_async
+import logging
+import time
+import uuid
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
 
-from chat.models import ChatSession, Chat, ChatHistory
+from api.authentication import load_token, token_cache
+from chat import history, presence, ratelimit, search
+from chat.buffers import history_buffer
+from chat.db import current_route, database_sync_to_async
+from chat.models import ChatSession, Chat, ChatHistory, user_group
+from chat.receipts import receipt_coalescer
 from chat.resolvers import MethodResolver, SerializerResolver, AbstractResolver
 from chat.serializers import ContactSerializer
+from lbdev_chat import metrics
+from lbdev_chat.routers import replica_reads
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_ID = 2 ** 63 - 1
 
+route_latency_histogram = metrics.histogram(
+    "chat_route_seconds",
+    "Time to resolve a chat route, from the frame being routed to its response.",
+    buckets=metrics.LATENCY_BUCKETS
+)
 
-async def run_resolver(resolver, data):
+
+async def run_resolver(resolver, context, data):
     if isinstance(resolver, AbstractResolver):
-        resolver.set_data(data)
-        return await resolver.resolve()
+        return await resolver.resolve(context, data)
 
 
 class ChatManager:
@@ -20,47 +40,70 @@ class ChatManager:
         self.user = None
         self.room_name = ""
         self.chat_session = None
-
-        self.resolvers = {
-            "authorization": MethodResolver(self.authorization),
-            "get_contacts": SerializerResolver(
-                serializer=ContactSerializer,
-                queryset=Chat.objects,
-                query_filter={"members__exact": lambda instance, data=None: instance.user.id},
-                context=self,
-                args={
-                    "many": True
-                }
-            ),
-            "message": MethodResolver(self.message_receive, context=self),
-            "get_contact": SerializerResolver(
-                serializer=ContactSerializer,
-                queryset=Chat.objects,
-                query_get={"pk": lambda instance, data: data["id"]}
-            )
-        }
+        self.last_seen_id = 0
+        self.last_write_at = None
 
     async def route_resolve(self, content):
-        await sync_to_async(print)(content)
         if "type" not in content:
-            await self._send_response("type_not_provided", {
+            return await self._send_response("type_not_provided", {
                 "message": "type route not provided"
             })
 
         if "data" not in content:
-            await self._send_response("data_not_provided", {
+            return await self._send_response("data_not_provided", {
                 "message": "data not provided"
             })
 
-        if content["type"] not in self.resolvers:
-            await self._send_response("type_not_found", {
+        resolver = self.resolvers.get(content["type"])
+        if resolver is None:
+            return await self._send_response("type_not_found", {
                 "message": "type route not found"
             })
 
-        response = await run_resolver(self.resolvers[content["type"]], content["data"])
+        retry_after = await ratelimit.check(self.rate_limit_identity, content["type"])
+        if retry_after:
+            return await self._send_response("rate_limited", {
+                "type": content["type"],
+                "retry_after": retry_after
+            })
+
+        if resolver.authenticated and self.user is None:
+            return await self._send_response(f"{content['type']}_response", {
+                "status": "error",
+                "message": "Not authorized"
+            })
+
+        started_at = time.perf_counter()
+        token = current_route.set(content["type"])
+        replica_token = replica_reads.set(resolver.read_only and not self.wrote_recently)
+        try:
+            response = await run_resolver(resolver, self, content["data"])
+        finally:
+            current_route.reset(token)
+            replica_reads.reset(replica_token)
+            if not resolver.read_only:
+                self.last_write_at = time.monotonic()
+            elapsed = time.perf_counter() - started_at
+            route_latency_histogram.observe(elapsed, route=content["type"])
+            if metrics.sampled():
+                logger.debug("route=%s user=%s seconds=%.6f", content["type"], self.user and self.user.id, elapsed)
+
         if response is not None:
             await self._send_response(f"{content['type']}_response", response)
 
+    @property
+    def wrote_recently(self):
+        # Reads right after a write of this socket stay on the primary so they see it.
+        if self.last_write_at is None:
+            return False
+        return time.monotonic() - self.last_write_at < settings.DB_REPLICA_STICKY_SECONDS
+
+    @property
+    def rate_limit_identity(self):
+        if self.user is not None:
+            return "user:{}".format(self.user.id)
+        return "channel:{}".format(self.consumer.channel_name)
+
     async def authorization(self, data):
         if "token" in data:
             try:
@@ -73,19 +116,28 @@ class ChatManager:
                     }
 
                 self.user = user
-                chat_session, created = await self.create_or_get_chat_session(user)
+                # Clients keep the device id across reconnects so the session cursor survives them.
+                device = str(data.get("device") or uuid.uuid4().hex)[:64]
+                chat_session, created = await self.create_or_get_chat_session(user, device)
 
                 self.chat_session = chat_session
+                self.last_seen_id = chat_session.last_seen_id
 
-                await self.set_online(True)
+                await presence.user_connected(user.id, self.consumer.channel_name)
 
-                self.room_name = str(chat_session.id)
-                sync_to_async(print)(self.room_name)
+                if data.get("batch"):
+                    self.consumer.enable_batching()
+
+                self.room_name = user_group(user.id)
+                if metrics.sampled():
+                    logger.debug("authorized user=%s session=%s", user.id, chat_session.id)
                 await self.consumer.timeout_stop()
                 await self.consumer.set_group()
 
                 return {
-                    "status": "success"
+                    "status": "success",
+                    "device": device,
+                    "last_seen": chat_session.last_seen_id
                 }
             except Token.DoesNotExist:
                 return {
@@ -94,26 +146,140 @@ class ChatManager:
                 }
 
     async def message_receive(self, data):
-        chat = await self.get_chat(data["to"])
-        await self.add_chat_history(data["content"], chat)
+        if settings.CHAT_WRITE_BUFFER:
+            # The batch checks the chat, a message only costs a thread hop per batch.
+            try:
+                chat_id = uuid.UUID(str(data["to"]))
+            except ValueError:
+                return {
+                    "status": "error",
+                    "message": "Chat not found"
+                }
+            try:
+                await history_buffer.add(ChatHistory(content=data["content"], chat_id=chat_id, sender=self.user))
+            except Chat.DoesNotExist:
+                return {
+                    "status": "error",
+                    "message": "Chat not found"
+                }
+        else:
+            chat = await self.get_chat(data["to"])
+            await self.add_chat_history(data["content"], chat)
+
+        return {
+            "status": "success"
+        }
+
+    async def get_token(self, token):
+        # Cache hits are answered on the event loop, only misses pay the database thread hop.
+        cached = token_cache.get(token)
+        if cached is not None:
+            return cached
+        return await database_sync_to_async(load_token)(token)
+
+    async def receipt(self, data):
+        try:
+            chat_id = uuid.UUID(str(data["chat"]))
+            message_id = int(data["id"])
+        except (KeyError, TypeError, ValueError):
+            message_id = 0
+        # Message ids are 64-bit, a larger one would fail every flush it is coalesced into.
+        if not 0 < message_id <= MAX_MESSAGE_ID:
+            return {
+                "status": "error",
+                "message": "Invalid receipt"
+            }
+        if not await self.is_chat_message(chat_id, message_id):
+            return {
+                "status": "error",
+                "message": "Message not found"
+            }
+        receipt_coalescer.add(chat_id, self.user.id, message_id)
 
     @database_sync_to_async
-    def set_online(self, value: bool):
-        if self.chat_session:
-            self.chat_session.online = value
-            self.chat_session.save()
+    def is_chat_message(self, chat_id, message_id):
+        return ChatHistory.objects.filter(pk=message_id, chat=chat_id, chat__members=self.user).exists()
 
     @database_sync_to_async
-    def get_token(self, token):
-        return Token.objects.select_related('user').get(key=token)
+    def get_history(self, data):
+        try:
+            chat_id = uuid.UUID(str(data["chat"]))
+        except (KeyError, ValueError):
+            chat_id = None
+        if chat_id is None or not Chat.objects.filter(pk=chat_id, members=self.user).exists():
+            return {
+                "status": "error",
+                "message": "Chat not found"
+            }
+        try:
+            limit = history.get_page_size(data.get("limit"))
+        except (TypeError, ValueError):
+            return {
+                "status": "error",
+                "message": "Invalid limit"
+            }
+        try:
+            return history.get_history_page(
+                chat_id,
+                self.user.id,
+                cursor=data.get("cursor"),
+                direction=data.get("direction", history.BEFORE),
+                limit=limit
+            )
+        except history.CursorError:
+            return {
+                "status": "error",
+                "message": "Invalid cursor"
+            }
+
+    @database_sync_to_async
+    def resume(self, data):
+        try:
+            since = self.last_seen_id if data.get("since") is None else int(data["since"])
+        except (TypeError, ValueError):
+            return {
+                "status": "error",
+                "message": "Invalid since"
+            }
+        try:
+            limit = history.get_page_size(data.get("limit"))
+        except (TypeError, ValueError):
+            return {
+                "status": "error",
+                "message": "Invalid limit"
+            }
+        page = history.get_unseen(self.user.id, since, limit=limit)
+        if page["messages"]:
+            self.seen(page["messages"][-1]["id"])
+        return page
+
+    @database_sync_to_async
+    def search_messages(self, data):
+        try:
+            offset = max(0, int(data.get("offset") or 0))
+            limit = history.get_page_size(data.get("limit"))
+        except (TypeError, ValueError):
+            return {
+                "status": "error",
+                "message": "Invalid offset or limit"
+            }
+        return search.search_messages(self.user.id, str(data.get("query", "")), offset=offset, limit=limit)
+
+    def seen(self, message_id):
+        if message_id > self.last_seen_id:
+            self.last_seen_id = message_id
+
+    @database_sync_to_async
+    def save_last_seen(self):
+        # Cursors only move forward, an older connection of the same device must not rewind it.
+        ChatSession.objects.filter(pk=self.chat_session.pk, last_seen_id__lt=self.last_seen_id).update(
+            last_seen_id=self.last_seen_id,
+            last_seen_at=timezone.now()
+        )
 
     @database_sync_to_async
     def get_chat_by_user(self, user_pk):
-        chat, created = Chat.objects.filter(members__exact=user_pk).get_or_create(members__exact=self.user.id)
-        if created:
-            chat.members.add(user_pk, self.user)
-            chat.save()
-        return chat, created
+        return Chat.objects.get_or_create_direct(self.user.id, user_pk)
 
     @database_sync_to_async
     def add_chat_history(self, content, chat):
@@ -125,11 +291,39 @@ class ChatManager:
         return Chat.objects.get(pk=chat_id)
 
     @database_sync_to_async
-    def create_or_get_chat_session(self, user):
-        return ChatSession.objects.get_or_create(user=user)
+    def create_or_get_chat_session(self, user, device):
+        return ChatSession.objects.get_or_create(user=user, device=device)
 
     async def on_disconnect(self):
-        await self.set_online(False)
+        if self.user is not None:
+            await presence.user_disconnected(self.user.id, self.consumer.channel_name)
+        if self.chat_session is not None and self.last_seen_id > self.chat_session.last_seen_id:
+            await self.save_last_seen()
 
     async def _send_response(self, response_type: str, data):
         return await self.consumer.send_response(response_type, data)
+
+    # The routing table is built once per process and shared by every connection.
+    resolvers = {
+        "authorization": MethodResolver(authorization, authenticated=False),
+        "get_contacts": SerializerResolver(
+            serializer=ContactSerializer,
+            queryset=lambda instance, data=None: Chat.objects.with_peer(instance.user.id).with_unread(instance.user.id),
+            query_filter={"members__exact": lambda instance, data=None: instance.user.id},
+            args={
+                "many": True
+            },
+            read_only=True
+        ),
+        "message": MethodResolver(message_receive),
+        "get_contact": SerializerResolver(
+            serializer=ContactSerializer,
+            queryset=lambda instance, data=None: Chat.objects.with_peer(instance.user.id).with_unread(instance.user.id),
+            query_get={"pk": lambda instance, data: data["id"]},
+            read_only=True
+        ),
+        "get_history": MethodResolver(get_history, read_only=True),
+        "receipt": MethodResolver(receipt),
+        "resume": MethodResolver(resume, read_only=True),
+        "search_messages": MethodResolver(search_messages, read_only=True)
+    }
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.8 on 2026-10-18 14:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_chatsession_online'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['chat', 'created_at', 'id'], name='chat_history_chat_time_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.8 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+def remove_duplicate_sessions(apps, schema_editor):
+    # Sessions used to be one per user, keep the oldest so the (user, device) constraint can be created.
+    ChatSession = apps.get_model('chat', 'ChatSession')
+    kept = set()
+    for session in ChatSession.objects.order_by('user_id', 'created_at').only('id', 'user_id'):
+        if session.user_id in kept:
+            session.delete()
+        else:
+            kept.add(session.user_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chathistory_chat_time_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='device',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_seen_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_seen_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(remove_duplicate_sessions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatsession',
+            constraint=models.UniqueConstraint(fields=('user', 'device'), name='chat_session_user_device_unique'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.8 on 2026-10-18 15:04
+
+from django.db import migrations, models
+
+
+def backfill_pair_key(apps, schema_editor):
+    # Chats with exactly two members are direct chats; duplicates left by concurrent creations keep no key.
+    Chat = apps.get_model('chat', 'Chat')
+    Members = Chat.members.through
+    members = {}
+    for chat_id, user_id in Members.objects.order_by('chat__created_at', 'user_id').values_list('chat_id', 'user_id'):
+        members.setdefault(chat_id, []).append(user_id)
+
+    used = set()
+    for chat_id, user_ids in members.items():
+        if len(user_ids) != 2:
+            continue
+        key = '{}:{}'.format(*sorted(user_ids))
+        if key not in used:
+            used.add(key)
+            Chat.objects.filter(pk=chat_id).update(pair_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatsession_device'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='pair_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_pair_key, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.8 on 2026-10-18 15:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_archivesegment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('count', models.PositiveSmallIntegerField(default=1)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chat.chat')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chat.chathistory')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='messageterm',
+            index=models.Index(fields=['term', 'chat'], name='message_term_term_chat_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 3.2.8 on 2026-10-18 15:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_member_states(apps, schema_editor):
+    # Counters start at zero, repair_chat_snapshots fills them and the snapshots of existing chats.
+    Chat = apps.get_model('chat', 'Chat')
+    ChatMemberState = apps.get_model('chat', 'ChatMemberState')
+    members = Chat.members.through.objects.values_list('chat_id', 'user_id').iterator()
+    ChatMemberState.objects.bulk_create(
+        (ChatMemberState(chat_id=chat_id, user_id=user_id) for chat_id, user_id in members),
+        batch_size=1000, ignore_conflicts=True
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0007_messageterm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_content',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='ChatMemberState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread', models.PositiveIntegerField(default=0)),
+                ('last_read_id', models.BigIntegerField(default=0)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chat.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chatmemberstate',
+            constraint=models.UniqueConstraint(fields=('chat', 'user'), name='chat_member_state_chat_user_unique'),
+        ),
+        migrations.RunPython(create_member_states, migrations.RunPython.noop),
+    ]
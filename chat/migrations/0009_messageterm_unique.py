@@ -0,0 +1,31 @@
+# Generated by Django 3.2.8 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+def remove_duplicate_postings(apps, schema_editor):
+    # Messages written during a rebuild could be indexed twice, keep one posting so the constraint can be created.
+    MessageTerm = apps.get_model('chat', 'MessageTerm')
+    duplicates = (
+        MessageTerm.objects.values('term', 'message').annotate(first=models.Min('id'), total=models.Count('id'))
+        .filter(total__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        MessageTerm.objects.filter(term=duplicate['term'], message=duplicate['message']).exclude(
+            id=duplicate['first']
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_chat_snapshots'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_postings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='messageterm',
+            constraint=models.UniqueConstraint(fields=('term', 'message'), name='message_term_term_message_unique'),
+        ),
+    ]
@@ -1,25 +1,116 @@
 import uuid
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import OuterRef, Subquery
+
+from chat import fanout as fanout_stage
+from chat import search as search_index
+from chat import snapshots
 
 # Create your models here.
 
 
+def user_group(user_id):
+    """
+    Channel layer group every connection of the user belongs to.
+    """
+    return "user.{}".format(user_id)
+
+
 class ChatSession(models.Model):
+    """
+    One per device of a user, keeps the highest message id the device has seen.
+    """
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    device = models.CharField(max_length=64, blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
     online = models.BooleanField(default=False)
+    last_seen_id = models.BigIntegerField(default=0)
+    last_seen_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "device"], name="chat_session_user_device_unique"),
+        ]
+
+
+def pair_key(user_id, peer_id):
+    """
+    Canonical key of the direct chat between two users, the same whatever the order they are given in.
+    """
+    return "{}:{}".format(*sorted((int(user_id), int(peer_id))))
+
+
+class ChatQuerySet(models.QuerySet):
+    def get_or_create_direct(self, user_id, peer_id):
+        """
+        Fetch the direct chat between two users by its pair key, creating it with both members when missing.
+        """
+        key = pair_key(user_id, peer_id)
+        try:
+            return self.get(pair_key=key), False
+        except self.model.DoesNotExist:
+            pass
+
+        try:
+            with transaction.atomic():
+                chat = self.create(pair_key=key)
+                chat.members.add(user_id, peer_id)
+            return chat, True
+        except IntegrityError:
+            # A concurrent caller created it first.
+            return self.get(pair_key=key), False
+
+    def with_peer(self, user_id):
+        """
+        Annotate every chat with the id and name of the member that is not ``user_id``.
+        """
+        # Ordered so the three annotations read the same member of a group chat.
+        peers = Chat.members.through.objects.filter(chat=OuterRef("pk")).exclude(user=user_id).order_by("user")
+        return self.annotate(
+            peer_id=Subquery(peers.values("user")[:1]),
+            peer_first_name=Subquery(peers.values("user__first_name")[:1]),
+            peer_last_name=Subquery(peers.values("user__last_name")[:1]),
+        )
+
+    def with_unread(self, user_id):
+        """
+        Annotate every chat with the unread counter of ``user_id``.
+        """
+        states = ChatMemberState.objects.filter(chat=OuterRef("pk"), user=user_id)
+        return self.annotate(unread=Subquery(states.values("unread")[:1]))
 
 
 class Chat(models.Model):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     created_at = models.DateTimeField(auto_now_add=True)
     chat_key = models.UUIDField(default=uuid.uuid4, unique=True)
+    pair_key = models.CharField(max_length=64, unique=True, blank=True, null=True)
     members = models.ManyToManyField(to=User)
+    # Snapshot of the newest message, kept up to date by chat.snapshots on every write.
+    last_message_id = models.BigIntegerField(blank=True, null=True)
+    last_message_sender = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name="+")
+    last_message_content = models.CharField(max_length=200, blank=True, default="")
+    last_message_at = models.DateTimeField(blank=True, null=True)
+
+    objects = ChatQuerySet.as_manager()
+
+
+class ChatMemberState(models.Model):
+    """
+    Per member counters of a chat: messages of the other members not acknowledged yet.
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    unread = models.PositiveIntegerField(default=0)
+    last_read_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["chat", "user"], name="chat_member_state_chat_user_unique"),
+        ]
 
 
 class ChatHistory(models.Model):
@@ -29,29 +120,54 @@ class ChatHistory(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     received_at = models.DateTimeField(blank=True, null=True)
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        sessions = ChatSession.objects.filter(user__chat=self.chat).all()
-        for chat_session in sessions:
-            print(str(chat_session.id))
-            if self.sender == chat_session.user:
-                direction = "send"
-            else:
-                direction = "received"
-            data = {
-                "pk": str(self.chat.pk),
-                "data": {
-                    "direction": direction,
-                    "content": self.content,
-                    "time": self.created_at.isoformat()
-                }
-            }
-
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                str(chat_session.id),
-                {
-                    "type": "send_message",
-                    "data": {"type": "message", "data": data}
-                }
-            )
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "created_at", "id"], name="chat_history_chat_time_idx"),
+        ]
+
+    def save(self, *args, fanout=True, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                search_index.index_messages([self])
+                snapshots.record_messages([self])
+        if fanout:
+            transaction.on_commit(lambda: fanout_stage.dispatch(self))
+
+
+class ArchiveSegment(models.Model):
+    """
+    Compressed, append-only file holding archived ChatHistory rows of one chat, oldest first.
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    file = models.FileField(upload_to="chat/archive/%Y/%m/")
+    count = models.PositiveIntegerField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "last_created_at", "last_id"], name="archive_segment_chat_time_idx"),
+        ]
+
+
+class MessageTerm(models.Model):
+    """
+    Posting of the inverted index used by ``search_messages``: ``term`` appears ``count`` times in ``message``.
+    """
+    term = models.CharField(max_length=64)
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    message = models.ForeignKey(ChatHistory, on_delete=models.CASCADE)
+    count = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["term", "chat"], name="message_term_term_chat_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["term", "message"], name="message_term_term_message_unique"),
+        ]
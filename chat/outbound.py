@@ -0,0 +1,184 @@
+import asyncio
+import logging
+from collections import deque
+
+from django.conf import settings
+
+from lbdev_chat import metrics
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+COLLAPSE = "collapse"
+DISCONNECT = "disconnect"
+
+queued_gauge = metrics.gauge("chat_send_queue_events", "Events waiting in the outbound queues of this process.")
+depth_histogram = metrics.histogram(
+    "chat_send_queue_depth",
+    "Depth of a connection's outbound queue when an event is queued.",
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+)
+drops_counter = metrics.counter("chat_send_queue_drops_total", "Events dropped or collapsed by a full outbound queue.")
+overflows_counter = metrics.counter(
+    "chat_send_queue_overflows_total",
+    "Connections closed with a resync hint because their outbound queue was full."
+)
+
+
+class OutboundBatcher:
+    """
+    Coalesces the group events of a connection into ``batch`` frames.
+
+    Events are collected for ``CHAT_BATCH_WINDOW_MS`` or until ``CHAT_BATCH_MAX_BYTES`` of encoded events are
+    pending, then sent as one frame. Types listed in ``CHAT_BATCH_BYPASS`` flush what is pending and are sent
+    right away.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.window = settings.CHAT_BATCH_WINDOW_MS / 1000
+        self.max_bytes = settings.CHAT_BATCH_MAX_BYTES
+        self.bypass = settings.CHAT_BATCH_BYPASS
+        self._events = []
+        self._size = 0
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    async def send(self, response_type, data):
+        event = self.consumer.codec.encode({"type": response_type, "data": data})
+        if response_type in self.bypass:
+            async with self._lock:
+                await self._send_pending()
+                await self._send_frame(event)
+            return
+
+        self._events.append(event)
+        self._size += len(event)
+        if self._size >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        async with self._lock:
+            await self._send_pending()
+
+    async def _send_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        events, self._events, self._size = self._events, [], 0
+        if len(events) == 1:
+            await self._send_frame(events[0])
+        elif events:
+            await self._send_frame(self.consumer.codec.encode_batch(events))
+
+    async def _send_frame(self, frame):
+        if self.consumer.codec.binary:
+            await self.consumer.send(bytes_data=frame)
+        else:
+            await self.consumer.send(text_data=frame)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._events, self._size = [], 0
+
+
+class OutboundQueue:
+    """
+    Bounded queue between the channel layer and a slow websocket.
+
+    Group events are queued without waiting for the socket, so the consumer keeps draining its channel and a
+    slow client never backs up the channel layer for the rest of the room. When ``CHAT_SEND_QUEUE_SIZE`` events
+    are pending the ``CHAT_SEND_QUEUE_POLICY`` makes room:
+
+    - ``drop_oldest`` drops the oldest queued event of a ``CHAT_EPHEMERAL_TYPES`` type,
+    - ``collapse`` replaces a queued event of the same ephemeral type and ``pk`` with the new one,
+    - ``disconnect`` does not make room.
+
+    If no room can be made the queue is discarded and the client is disconnected with a ``resync`` hint.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.size = settings.CHAT_SEND_QUEUE_SIZE
+        self.policy = settings.CHAT_SEND_QUEUE_POLICY
+        self.ephemeral = settings.CHAT_EPHEMERAL_TYPES
+        self.closed = False
+        self._events = deque()
+        self._wakeup = asyncio.Event()
+        self._writer = None
+
+    def __len__(self):
+        return len(self._events)
+
+    def put(self, response_type, data):
+        if self.closed:
+            return False
+
+        if len(self._events) >= self.size and not self._make_room(response_type, data):
+            self._overflow()
+            return False
+
+        depth_histogram.observe(len(self._events))
+        self._events.append((response_type, data))
+        queued_gauge.inc()
+        self._wakeup.set()
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write())
+        return True
+
+    def _drop(self, index, response_type):
+        del self._events[index]
+        queued_gauge.dec()
+        drops_counter.inc(policy=self.policy, type=response_type)
+
+    def _make_room(self, response_type, data):
+        if self.policy == DROP_OLDEST:
+            for index, (queued_type, queued_data) in enumerate(self._events):
+                if queued_type in self.ephemeral:
+                    self._drop(index, queued_type)
+                    return True
+
+        elif self.policy == COLLAPSE and response_type in self.ephemeral:
+            key = data.get("pk") if isinstance(data, dict) else None
+            for index, (queued_type, queued_data) in enumerate(self._events):
+                queued_key = queued_data.get("pk") if isinstance(queued_data, dict) else None
+                if queued_type == response_type and queued_key == key:
+                    self._drop(index, queued_type)
+                    return True
+
+        return False
+
+    def _overflow(self):
+        overflows_counter.inc(policy=self.policy)
+        self.close()
+        asyncio.ensure_future(self.consumer.resync_and_close())
+
+    async def _write(self):
+        while True:
+            while not self._events:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            response_type, data = self._events.popleft()
+            queued_gauge.dec()
+            try:
+                await self.consumer.deliver(response_type, data)
+            except Exception:
+                # One bad event must not stop the writer, the rest of the queue would wait for an overflow.
+                logger.exception("outbound delivery failed type=%s", response_type)
+
+    def close(self):
+        self.closed = True
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        self._writer = None
+        queued_gauge.dec(len(self._events))
+        self._events.clear()
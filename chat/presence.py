@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from chat.db import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+
+class LocalPresence:
+    """
+    In-process connection registry, used when the channel layer is not backed by Redis (tests, single worker).
+    """
+
+    def __init__(self):
+        self._connections = {}
+
+    async def connect(self, user_id, connection_id):
+        self._connections.setdefault(user_id, set()).add(connection_id)
+        return len(self._connections[user_id])
+
+    async def disconnect(self, user_id, connection_id):
+        connections = self._connections.get(user_id, set())
+        connections.discard(connection_id)
+        if not connections:
+            self._connections.pop(user_id, None)
+        return len(connections)
+
+    async def count(self, user_id):
+        return len(self._connections.get(user_id, ()))
+
+    async def online_many(self, user_ids):
+        return {user_id: user_id in self._connections for user_id in user_ids}
+
+    def clear(self):
+        self._connections.clear()
+
+
+class RedisPresence:
+    """
+    Connections of every user kept in the channel layer Redis so every worker sees the same presence.
+
+    Each user has a sorted set of connection ids scored by their expiry. Workers push the expiry of their own
+    connections forward every third of ``CHAT_PRESENCE_TTL``, the connections of a crashed worker expire on their
+    own instead of keeping the user online.
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        # Connections opened by this process, the ones its heartbeat keeps alive.
+        self._connections = {}
+        self._heartbeat = None
+
+    def _key(self, user_id):
+        return "{}presence.connections:{}".format(self.channel_layer.prefix, user_id)
+
+    def _connection(self, key):
+        return self.channel_layer.connection(self.channel_layer.consistent_hash(key))
+
+    async def connect(self, user_id, connection_id):
+        self._connections[connection_id] = user_id
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.ensure_future(self._beat())
+
+        key = self._key(user_id)
+        now = time.time()
+        async with self._connection(key) as connection:
+            transaction = connection.multi_exec()
+            transaction.zremrangebyscore(key, max=now)
+            transaction.zadd(key, now + settings.CHAT_PRESENCE_TTL, connection_id)
+            transaction.expire(key, settings.CHAT_PRESENCE_TTL)
+            transaction.zcard(key)
+            return (await transaction.execute())[-1]
+
+    async def disconnect(self, user_id, connection_id):
+        self._connections.pop(connection_id, None)
+        key = self._key(user_id)
+        async with self._connection(key) as connection:
+            transaction = connection.multi_exec()
+            transaction.zrem(key, connection_id)
+            transaction.zremrangebyscore(key, max=time.time())
+            transaction.zcard(key)
+            return (await transaction.execute())[-1]
+
+    async def count(self, user_id):
+        key = self._key(user_id)
+        async with self._connection(key) as connection:
+            return await connection.zcount(key, min=time.time())
+
+    async def online_many(self, user_ids):
+        shards = {}
+        for user_id in user_ids:
+            key = self._key(user_id)
+            shards.setdefault(self.channel_layer.consistent_hash(key), []).append((user_id, key))
+
+        now = time.time()
+
+        async def read_shard(index, entries):
+            async with self.channel_layer.connection(index) as connection:
+                pipeline = connection.pipeline()
+                counts = [pipeline.zcount(key, min=now) for user_id, key in entries]
+                await pipeline.execute()
+            return {user_id: (await count) > 0 for (user_id, key), count in zip(entries, counts)}
+
+        online = {}
+        for result in await asyncio.gather(*(read_shard(index, entries) for index, entries in shards.items())):
+            online.update(result)
+        return online
+
+    async def refresh(self):
+        """
+        Push the expiry of the connections of this process forward.
+        """
+        expires_at = time.time() + settings.CHAT_PRESENCE_TTL
+        shards = {}
+        for connection_id, user_id in list(self._connections.items()):
+            key = self._key(user_id)
+            shards.setdefault(self.channel_layer.consistent_hash(key), []).append((key, connection_id))
+
+        for index, entries in shards.items():
+            async with self.channel_layer.connection(index) as connection:
+                pipeline = connection.pipeline()
+                for key, connection_id in entries:
+                    # Only existing members, a connection closed meanwhile must not come back.
+                    pipeline.zadd(key, expires_at, connection_id, exist=connection.ZSET_IF_EXIST)
+                    pipeline.expire(key, settings.CHAT_PRESENCE_TTL)
+                await pipeline.execute()
+
+    async def _beat(self):
+        while self._connections:
+            await asyncio.sleep(settings.CHAT_PRESENCE_TTL / 3)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.warning("presence refresh failed", exc_info=True)
+
+
+_local_presence = LocalPresence()
+_registries = {}
+
+
+def get_presence():
+    channel_layer = get_channel_layer()
+    if not hasattr(channel_layer, "connection"):
+        return _local_presence
+
+    registry = _registries.get(id(channel_layer))
+    if registry is None or registry.channel_layer is not channel_layer:
+        registry = _registries[id(channel_layer)] = RedisPresence(channel_layer)
+    return registry
+
+
+def online_many(user_ids):
+    """
+    Synchronous presence lookup for code running in a database thread (serializers).
+    """
+    user_ids = [user_id for user_id in user_ids if user_id is not None]
+    if not user_ids:
+        return {}
+    return async_to_sync(get_presence().online_many)(user_ids)
+
+
+@database_sync_to_async
+def get_contacts(user_id):
+    from chat.models import Chat
+
+    return list(
+        Chat.members.through.objects.filter(chat__members=user_id).exclude(user=user_id).values_list("user", "chat")
+    )
+
+
+async def notify_contacts(user_id, online):
+    from chat import fanout
+    from chat.models import user_group
+
+    events = {}
+    for contact_id, chat_id in await get_contacts(user_id):
+        events.setdefault(user_group(contact_id), []).append({
+            "type": "send_message",
+            "data": {"type": "presence", "data": {"pk": str(chat_id), "online": online}}
+        })
+    if events:
+        await fanout.publish(events)
+
+
+async def connections_changed(user_id):
+    from chat.models import user_group
+
+    # Other processes cache the connection count of the user for their local delivery, see chat.local.
+    await get_channel_layer().group_send(user_group(user_id), {"type": "connections.changed"})
+
+
+async def user_connected(user_id, connection_id):
+    count = await get_presence().connect(user_id, connection_id)
+    await connections_changed(user_id)
+    if count == 1:
+        await notify_contacts(user_id, True)
+
+
+async def user_disconnected(user_id, connection_id):
+    count = await get_presence().disconnect(user_id, connection_id)
+    await connections_changed(user_id)
+    if count == 0:
+        await notify_contacts(user_id, False)
@@ -0,0 +1,115 @@
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from lbdev_chat import metrics
+
+rejections_counter = metrics.counter("chat_rate_limited_total", "Frames rejected by the per-user rate limiter.")
+
+# KEYS[1] bucket key, ARGV rate, burst, now. Returns the seconds to wait, 0 when a token was taken.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+    def is_full(self, rate, burst, now):
+        return self.tokens + (now - self.updated) * rate >= burst
+
+
+class LocalRateLimiter:
+    """
+    Token buckets kept in this process, limits are per worker.
+    """
+
+    max_buckets = 100000
+
+    def __init__(self):
+        self._buckets = {}
+
+    def _purge(self, now):
+        # Full buckets carry no state, dropping them is the same as starting a new one.
+        for key in [key for key, (bucket, rate, burst) in self._buckets.items() if bucket.is_full(rate, burst, now)]:
+            del self._buckets[key]
+
+    async def take(self, key, rate, burst):
+        now = time.monotonic()
+        entry = self._buckets.get(key)
+        if entry is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._purge(now)
+            entry = self._buckets[key] = (TokenBucket(burst, now), rate, burst)
+        return entry[0].take(rate, burst, now)
+
+
+class RedisRateLimiter:
+    """
+    Token buckets kept in the channel layer Redis, limits are shared by every worker.
+    """
+
+    async def take(self, key, rate, burst):
+        channel_layer = get_channel_layer()
+        key = "{}ratelimit:{}".format(channel_layer.prefix, key)
+        async with channel_layer.connection(channel_layer.consistent_hash(key)) as connection:
+            wait = await connection.eval(TOKEN_BUCKET_SCRIPT, keys=[key], args=[rate, burst, time.time()])
+        return float(wait)
+
+
+_local_limiter = LocalRateLimiter()
+_redis_limiter = RedisRateLimiter()
+
+
+def get_limiter():
+    if settings.CHAT_RATE_LIMIT_BACKEND == "redis":
+        return _redis_limiter
+    return _local_limiter
+
+
+def get_limit(route):
+    limits = settings.CHAT_RATE_LIMITS
+    return limits.get(route, limits.get("default"))
+
+
+async def check(identity, route):
+    """
+    Take a token for ``route`` from the bucket of ``identity``, returns the seconds to wait when none is left.
+    """
+    limit = get_limit(route)
+    if not limit:
+        return 0
+
+    rate, burst = limit
+    retry_after = await get_limiter().take("{}:{}".format(identity, route), rate, burst)
+    if retry_after:
+        rejections_counter.inc(route=route)
+    return retry_after
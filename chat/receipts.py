@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import operator
+from functools import reduce
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from chat import fanout, snapshots
+from chat.db import database_sync_to_async
+from chat.models import Chat, ChatHistory
+from lbdev_chat import metrics
+
+logger = logging.getLogger(__name__)
+
+acks_counter = metrics.counter("chat_receipt_acks_total", "Receipt acknowledgements received from clients.")
+updates_counter = metrics.counter("chat_receipt_updates_total", "Ranged received_at updates applied on flush.")
+flush_errors_counter = metrics.counter("chat_receipt_flush_errors_total", "Receipt flushes that failed.")
+dropped_counter = metrics.counter("chat_receipt_dropped_total", "Receipt acknowledgements dropped after failing alone.")
+
+
+class ReceiptCoalescer:
+    """
+    Collects receipt acknowledgements in memory and applies them every ``interval`` milliseconds.
+
+    Only the highest acknowledged message per chat and member is kept, so a flush runs one ranged update per
+    chat no matter how many messages were acknowledged, and senders get one aggregated receipt event.
+    """
+
+    def __init__(self, interval=None):
+        self._interval = interval
+        self._pending = {}
+        self._timer = None
+
+    @property
+    def interval(self):
+        if self._interval is None:
+            return settings.CHAT_RECEIPT_FLUSH_MS
+        return self._interval
+
+    def add(self, chat_id, user_id, message_id):
+        acks_counter.inc()
+        key = (chat_id, user_id)
+        if message_id > self._pending.get(key, 0):
+            self._pending[key] = message_id
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval / 1000, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, {}
+        if batch:
+            return fanout.watch(asyncio.ensure_future(self._flush(batch)), flush_errors_counter, "receipt flush")
+
+    async def _flush(self, batch):
+        try:
+            events = await self.apply(batch)
+        except OperationalError:
+            # Transient, keep the acknowledgements for the next flush, a newer one of the same member still wins.
+            for key, message_id in batch.items():
+                if message_id > self._pending.get(key, 0):
+                    self._pending[key] = message_id
+            if self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.interval / 1000, self.flush)
+            raise
+        except Exception:
+            # Retrying would fail the same way, apply the acknowledgements alone so only the bad ones are lost.
+            logger.warning("receipt flush failed, applying acknowledgements one by one", exc_info=True)
+            events = await self.apply_each(batch)
+        if events:
+            await fanout.publish(events)
+
+    @classmethod
+    @database_sync_to_async
+    def apply(cls, batch):
+        return cls._apply(batch)
+
+    @classmethod
+    @database_sync_to_async
+    def apply_each(cls, batch):
+        events = {}
+        for key, message_id in batch.items():
+            try:
+                with transaction.atomic():
+                    applied = cls._apply({key: message_id})
+            except Exception:
+                dropped_counter.inc()
+                logger.error("dropping receipt %s of user %s in chat %s", message_id, key[1], key[0], exc_info=True)
+                continue
+            for group, group_events in applied.items():
+                events.setdefault(group, []).extend(group_events)
+        return events
+
+    @staticmethod
+    def _apply(batch):
+        memberships = set(
+            Chat.members.through.objects.filter(
+                chat__in={chat_id for chat_id, user_id in batch},
+                user__in={user_id for chat_id, user_id in batch}
+            ).values_list("chat_id", "user_id")
+        )
+
+        acks = {}
+        for (chat_id, user_id), message_id in batch.items():
+            if (chat_id, user_id) not in memberships:
+                continue
+            snapshots.record_receipt(chat_id, user_id, message_id)
+            acks.setdefault(chat_id, []).append((user_id, message_id))
+
+        received_at = timezone.now()
+        applied = []
+        for chat_id, members in acks.items():
+            # One update per chat, every member marks the messages of the others up to its acknowledgement.
+            condition = reduce(operator.or_, (
+                Q(id__lte=message_id) & ~Q(sender=user_id) for user_id, message_id in members
+            ))
+            updated = ChatHistory.objects.filter(condition, chat=chat_id, received_at__isnull=True).update(
+                received_at=received_at
+            )
+            if updated:
+                updates_counter.inc()
+                applied.extend((chat_id, user_id, message_id) for user_id, message_id in members)
+
+        if not applied:
+            return {}
+
+        recipients = fanout.get_recipients({chat_id for chat_id, user_id, message_id in applied})
+        events = {}
+        for chat_id, user_id, message_id in applied:
+            event = {
+                "type": "send_message",
+                "data": {
+                    "type": "receipt",
+                    "data": {"pk": str(chat_id), "id": message_id, "time": received_at.isoformat()}
+                }
+            }
+            for group, member_id in recipients.get(chat_id, ()):
+                if member_id != user_id:
+                    events.setdefault(group, []).append(event)
+        return events
+
+receipt_coalescer = ReceiptCoalescer()
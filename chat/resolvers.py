@@ -1,19 +1,22 @@
 import abc
 
-from channels.db import database_sync_to_async
+from chat.db import database_sync_to_async
 
 
 class AbstractResolver(abc.ABC):
+    """
+    A route of the chat socket.
 
-    def __init__(self, context=None):
-        self.data = None
-        self.context = context
-
-    def set_data(self, data):
-        self.data = data
+    Resolvers are built once per process and shared by every connection, all the per-request state is passed
+    to ``resolve``: the ``context`` (the connection's ChatManager) and the frame ``data``. Routes built with
+    ``read_only=True`` may be answered from a read replica, routes built with ``authenticated=False`` are
+    served before the authorization.
+    """
+    read_only = False
+    authenticated = True
 
     @abc.abstractmethod
-    def resolve(self):
+    def resolve(self, context, data):
         pass
 
 
@@ -23,8 +26,7 @@ class ResolverError(Exception):
 
 class SerializerResolver(AbstractResolver):
     def __init__(self, serializer, queryset, args=None, query_filter=None, query_exclude=None, query_get=None,
-                 context=None):
-        super().__init__(context=context)
+                 read_only=False, authenticated=True):
         if args is None:
             args = {}
         self.serializer = serializer
@@ -33,35 +35,35 @@ class SerializerResolver(AbstractResolver):
         self.exclude = query_exclude
         self.get = query_get
         self.args = args
+        self.read_only = read_only
+        self.authenticated = authenticated
 
-    def resolve_callables(self, target):
-        if isinstance(target, dict):
-            for x in target:
-                if callable(target[x]):
-                    target[x] = target[x](self.context, self.data)
+    @staticmethod
+    def resolve_callables(target, context, data):
+        if not isinstance(target, dict):
+            return target
+        return {key: value(context, data) if callable(value) else value for key, value in target.items()}
 
-    def resolve_all_callables(self):
-        self.resolve_callables(self.filter)
-        self.resolve_callables(self.exclude)
-        self.resolve_callables(self.get)
+    def get_queryset(self, context, data):
+        queryset = self.queryset(context, data) if callable(self.queryset) else self.queryset
 
-    def apply_query_set(self):
-        self.resolve_all_callables()
-        if self.filter:
-            self.queryset = self.queryset.filter(**self.filter)
+        query_filter = self.resolve_callables(self.filter, context, data)
+        if query_filter:
+            queryset = queryset.filter(**query_filter)
 
-        if self.exclude:
-            self.queryset = self.queryset.exclude(**self.exclude)
+        query_exclude = self.resolve_callables(self.exclude, context, data)
+        if query_exclude:
+            queryset = queryset.exclude(**query_exclude)
 
-        if self.get:
-            self.queryset = self.queryset.get(**self.get)
+        query_get = self.resolve_callables(self.get, context, data)
+        if query_get:
+            return queryset.get(**query_get)
 
-        self.args["instance"] = self.queryset
+        return queryset
 
     @database_sync_to_async
-    def resolve(self):
-        self.apply_query_set()
-        serializer = self.serializer(**self.args, context=self.context)
+    def resolve(self, context, data):
+        serializer = self.serializer(instance=self.get_queryset(context, data), context=context, **self.args)
 
         if "data" in self.args:
             if not serializer.is_valid():
@@ -70,9 +72,14 @@ class SerializerResolver(AbstractResolver):
 
 
 class MethodResolver(AbstractResolver):
-    def __init__(self, method, context=None):
-        super().__init__(context=context)
+    """
+    Resolves a route with a ChatManager method, given unbound so the resolver can be shared.
+    """
+
+    def __init__(self, method, read_only=False, authenticated=True):
         self.method = method
+        self.read_only = read_only
+        self.authenticated = authenticated
 
-    def resolve(self):
-        return self.method(self.data)
+    def resolve(self, context, data):
+        return self.method(context, data)
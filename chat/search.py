@@ -0,0 +1,89 @@
+import collections
+import re
+import unicodedata
+
+from django.db import transaction
+from django.db.models import Count, Sum
+
+TOKEN_RE = re.compile(r"\w+")
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 10
+
+
+def tokenize(text):
+    """
+    Count of every indexed term of ``text``: lower case words of 2+ characters without accents.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return collections.Counter(token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall(text) if len(token) > 1)
+
+
+def index_messages(chat_histories):
+    """
+    Add the postings of saved ChatHistory rows, called in the transaction that writes them.
+
+    Postings already there are kept, a message indexed by both a write and a running ``rebuild`` counts once.
+    """
+    from chat.models import MessageTerm
+
+    MessageTerm.objects.bulk_create([
+        MessageTerm(term=term, chat_id=chat_history.chat_id, message_id=chat_history.pk, count=min(count, 32767))
+        for chat_history in chat_histories
+        for term, count in tokenize(chat_history.content).items()
+    ], batch_size=1000, ignore_conflicts=True)
+
+
+def rebuild(batch_size=1000):
+    """
+    Drop and rebuild the whole index, walking ChatHistory by id in ``batch_size`` transactions.
+    """
+    from chat.models import ChatHistory, MessageTerm
+
+    MessageTerm.objects.all().delete()
+    last_id = total = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                ChatHistory.objects.filter(id__gt=last_id).order_by("id").only("id", "chat_id", "content")[:batch_size]
+            )
+            if not batch:
+                return total
+            index_messages(batch)
+        last_id = batch[-1].pk
+        total += len(batch)
+
+
+def search_messages(user_id, query, offset=0, limit=10):
+    """
+    Messages of the chats of ``user_id`` matching ``query``.
+
+    Results are ranked by the number of distinct query terms they contain, then by how often they contain them,
+    newest first on ties.
+    """
+    from chat.models import Chat, ChatHistory, MessageTerm
+
+    terms = [term for term, count in tokenize(query).most_common(MAX_QUERY_TERMS)]
+    if not terms:
+        return {"results": [], "next": None}
+
+    chats = Chat.members.through.objects.filter(user=user_id).values("chat")
+    ranked = list(
+        MessageTerm.objects.filter(term__in=terms, chat__in=chats).values("message")
+        .annotate(matched=Count("term"), score=Sum("count")).order_by("-matched", "-score", "-message")
+        .values_list("message", flat=True)[offset:offset + limit + 1]
+    )
+    messages = ChatHistory.objects.in_bulk(ranked[:limit])
+
+    return {
+        "results": [
+            {
+                "pk": str(messages[pk].chat_id),
+                "id": pk,
+                "direction": "send" if messages[pk].sender_id == user_id else "received",
+                "content": messages[pk].content,
+                "time": messages[pk].created_at
+            } for pk in ranked[:limit] if pk in messages
+        ],
+        "next": offset + limit if len(ranked) > limit else None
+    }
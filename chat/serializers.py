@@ -1,25 +1,48 @@
-from django.contrib.auth.models import User
 from rest_framework import serializers
 
-from chat.models import Chat, ChatSession
+from chat import presence
+from chat.models import Chat
+
+
+class ContactListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        chats = list(data.all() if hasattr(data, "all") else data)
+        # One presence lookup for the whole list instead of one per contact.
+        self.online = presence.online_many([chat.peer_id for chat in chats])
+        return super().to_representation(chats)
 
 
 class ContactSerializer(serializers.ModelSerializer):
+    """
+    Serializes chats annotated by ``Chat.objects.with_peer`` and ``with_unread``.
+    """
     name = serializers.SerializerMethodField()
     online = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
 
     def get_name(self, instance: Chat):
-        user = instance.members.exclude(id=self.context.user.pk).first()
-        return '{} {}'.format(user.first_name, user.last_name)
+        return '{} {}'.format(instance.peer_first_name, instance.peer_last_name)
 
     def get_online(self, instance: Chat):
-        user = instance.members.exclude(id=self.context.user.pk).first()
-        try:
-            chat_session = ChatSession.objects.get(user=user.pk)
-            return chat_session.online
-        except ChatSession.DoesNotExist:
-            return False
+        if isinstance(self.parent, ContactListSerializer):
+            return self.parent.online.get(instance.peer_id, False)
+        return presence.online_many([instance.peer_id]).get(instance.peer_id, False)
+
+    def get_unread(self, instance: Chat):
+        return instance.unread or 0
+
+    def get_last_message(self, instance: Chat):
+        if instance.last_message_id is None:
+            return None
+        return {
+            "id": instance.last_message_id,
+            "direction": "received" if instance.last_message_sender_id == instance.peer_id else "send",
+            "content": instance.last_message_content,
+            "time": instance.last_message_at
+        }
 
     class Meta:
         model = Chat
-        fields = ('pk', 'name', 'online')
+        fields = ('pk', 'name', 'online', 'unread', 'last_message')
+        list_serializer_class = ContactListSerializer
@@ -0,0 +1,26 @@
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from chat import snapshots
+from chat.models import Chat, ChatMemberState
+
+
+@receiver(m2m_changed, sender=Chat.members.through)
+def sync_member_states(sender, instance, action, reverse, pk_set, **kwargs):
+    # Every member gets its counters row when it joins, so writes only have to update existing rows.
+    if action == "post_add":
+        if reverse:
+            for chat_id in pk_set:
+                snapshots.create_member_states(chat_id, [instance.pk])
+        else:
+            snapshots.create_member_states(instance.pk, pk_set)
+    elif action == "post_remove":
+        if reverse:
+            ChatMemberState.objects.filter(chat__in=pk_set, user=instance.pk).delete()
+        else:
+            ChatMemberState.objects.filter(chat=instance.pk, user__in=pk_set).delete()
+    elif action == "post_clear":
+        if reverse:
+            ChatMemberState.objects.filter(user=instance.pk).delete()
+        else:
+            ChatMemberState.objects.filter(chat=instance.pk).delete()
@@ -0,0 +1,89 @@
+import collections
+
+from django.db import transaction
+from django.db.models import F, Q
+
+
+def create_member_states(chat_id, user_ids):
+    from chat.models import ChatMemberState
+
+    ChatMemberState.objects.bulk_create(
+        [ChatMemberState(chat_id=chat_id, user_id=user_id) for user_id in user_ids], ignore_conflicts=True
+    )
+
+
+def record_messages(chat_histories):
+    """
+    Move the last message snapshot and the unread counters forward for saved ChatHistory rows, called in the
+    transaction that writes them.
+    """
+    from chat.models import Chat, ChatMemberState
+
+    latest = {}
+    sent = collections.Counter()
+    for chat_history in chat_histories:
+        if chat_history.chat_id not in latest or chat_history.pk > latest[chat_history.chat_id].pk:
+            latest[chat_history.chat_id] = chat_history
+        sent[(chat_history.chat_id, chat_history.sender_id)] += 1
+
+    # Rows are always touched in the same order so concurrent writers cannot deadlock.
+    for chat_id, chat_history in sorted(latest.items(), key=lambda item: str(item[0])):
+        newer = Q(last_message_id__isnull=True) | Q(last_message_id__lt=chat_history.pk)
+        Chat.objects.filter(newer, pk=chat_id).update(
+            last_message_id=chat_history.pk,
+            last_message_sender=chat_history.sender_id,
+            last_message_content=chat_history.content[:200],
+            last_message_at=chat_history.created_at
+        )
+    for (chat_id, sender_id), count in sorted(sent.items(), key=lambda item: (str(item[0][0]), item[0][1] or 0)):
+        ChatMemberState.objects.filter(chat=chat_id).exclude(user=sender_id).update(unread=F("unread") + count)
+
+
+def record_receipt(chat_id, user_id, message_id):
+    """
+    Recount the unread messages of a member that acknowledged every message up to ``message_id``.
+    """
+    from chat.models import ChatHistory, ChatMemberState
+
+    with transaction.atomic():
+        # The lock orders this recount with the increments of messages being written concurrently.
+        state = ChatMemberState.objects.select_for_update().filter(
+            chat=chat_id, user=user_id, last_read_id__lt=message_id
+        ).first()
+        if state is None:
+            return
+        state.last_read_id = message_id
+        state.unread = ChatHistory.objects.filter(chat=chat_id, id__gt=message_id).exclude(sender=user_id).count()
+        state.save(update_fields=["last_read_id", "unread"])
+
+
+def repair(chat):
+    """
+    Recompute the snapshot and the member counters of a chat from its messages.
+    """
+    from chat import archive
+    from chat.models import ChatHistory, ChatMemberState
+
+    with transaction.atomic():
+        latest = ChatHistory.objects.filter(chat=chat).order_by("-id").first()
+        if latest is not None:
+            chat.last_message_id, chat.last_message_sender_id = latest.pk, latest.sender_id
+            chat.last_message_content, chat.last_message_at = latest.content[:200], latest.created_at
+        else:
+            archived = archive.get_archived_rows(chat.pk, limit=1)
+            if archived:
+                pk, sender_id, content, created_at = archived[0]
+            else:
+                pk = sender_id = created_at = None
+                content = ""
+            chat.last_message_id, chat.last_message_sender_id = pk, sender_id
+            chat.last_message_content, chat.last_message_at = content[:200], created_at
+        chat.save(update_fields=["last_message_id", "last_message_sender", "last_message_content", "last_message_at"])
+
+        create_member_states(chat.pk, chat.members.values_list("id", flat=True))
+        # The same count as record_receipt: messages of the other members past the last one acknowledged.
+        for state in ChatMemberState.objects.select_for_update().filter(chat=chat):
+            state.unread = ChatHistory.objects.filter(chat=chat, id__gt=state.last_read_id).exclude(
+                sender=state.user_id
+            ).count()
+            state.save(update_fields=["unread"])
@@ -1,3 +1,1320 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, router, transaction
+from django.db.models import QuerySet
+from django.test import TransactionTestCase, override_settings
+from rest_framework.authtoken.models import Token
+
+from chat import archive, codecs, db, fanout, history, local, outbound, presence, ratelimit, receipts, search
+from chat.benchmarks import run_benchmark, run_search_benchmark
+from chat.buffers import ChatHistoryBuffer, flush_errors_counter
+from chat.consumers import ChatConsumer
+from chat.managers import ChatManager, run_resolver
+from chat.models import ArchiveSegment, Chat, ChatHistory, ChatMemberState, ChatSession, MessageTerm
+from chat.outbound import OutboundBatcher, OutboundQueue
+from chat.receipts import ReceiptCoalescer, receipt_coalescer
+from chat.resolvers import MethodResolver
+from lbdev_chat import metrics
+from lbdev_chat.layers import ShardedRedisChannelLayer, jump_hash
+from lbdev_chat.routers import replica_reads
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def create_contacts(user, count, start=0):
+    for index in range(start, start + count):
+        contact = User.objects.create(username='contact{}'.format(index), first_name='Contact', last_name=str(index))
+        if index % 2 == 0:
+            async_to_sync(presence.get_presence().connect)(contact.id, 'socket{}'.format(index))
+        chat = Chat.objects.create()
+        chat.members.add(user, contact)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ContactListTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.manager = ChatManager(consumer=None)
+        self.manager.user = self.user
+
+    def tearDown(self):
+        presence._local_presence.clear()
+
+    def get_contacts(self):
+        return async_to_sync(run_resolver)(self.manager.resolvers["get_contacts"], self.manager, {})
+
+    def test_get_contacts_content(self):
+        create_contacts(self.user, 2)
+
+        contacts = sorted(self.get_contacts(), key=lambda contact: contact["name"])
+
+        self.assertEqual([contact["name"] for contact in contacts], ['Contact 0', 'Contact 1'])
+        self.assertEqual([contact["online"] for contact in contacts], [True, False])
+
+    def test_group_chat_peer_is_one_member(self):
+        first = User.objects.create(username='first', first_name='First', last_name='1')
+        second = User.objects.create(username='second', first_name='Second', last_name='2')
+        chat = Chat.objects.create()
+        chat.members.add(self.user, second, first)
+
+        peer = Chat.objects.with_peer(self.user.id).values('peer_id', 'peer_first_name', 'peer_last_name').get()
+
+        self.assertEqual(peer, {'peer_id': first.id, 'peer_first_name': 'First', 'peer_last_name': '1'})
+
+    def test_get_contacts_query_count_is_constant(self):
+        create_contacts(self.user, 1)
+        with self.assertNumQueries(1):
+            self.get_contacts()
+
+        create_contacts(self.user, 50, start=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.get_contacts()), 51)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class AuthTimeoutTestCase(TransactionTestCase):
+    @override_settings(CHAT_AUTH_TIMEOUT=0.05)
+    def test_unauthenticated_socket_is_closed(self):
+        async def run():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual((await communicator.receive_json_from())["type"], "info")
+
+            response = await communicator.receive_json_from(timeout=1)
+            self.assertEqual(response["type"], "authorization_response")
+            self.assertFalse(response["data"]["accepted"])
+            self.assertEqual((await communicator.receive_output(timeout=1))["type"], "websocket.close")
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_pending_handshakes_do_not_start_threads(self):
+        async def run():
+            threads_before = threading.active_count()
+            communicators = []
+            for _ in range(2000):
+                communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat')
+                await communicator.connect()
+                await communicator.receive_json_from()
+                communicators.append(communicator)
+            threads_after = threading.active_count()
+
+            await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+            return threads_before, threads_after
+
+        threads_before, threads_after = async_to_sync(run)()
+        self.assertLessEqual(threads_after - threads_before, 2)
+
+
+class FanoutTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.contact = User.objects.create(username='contact')
+        self.chat = Chat.objects.create()
+        self.chat.members.add(self.user, self.contact)
+
+    def test_publishes_after_commit(self):
+        with mock.patch.object(fanout, 'publish', new=mock.AsyncMock()) as publish:
+            with transaction.atomic():
+                chat_history = ChatHistory.objects.create(chat=self.chat, sender=self.user, content='hello')
+                publish.assert_not_called()
+            publish.assert_called_once()
+
+        events = publish.call_args[0][0]
+        sent = events['user.{}'.format(self.user.id)][0]['data']['data']
+        received = events['user.{}'.format(self.contact.id)][0]['data']['data']
+        self.assertEqual(sent['pk'], str(self.chat.pk))
+        self.assertEqual((sent['data']['id'], sent['data']['direction']), (chat_history.pk, 'send'))
+        self.assertEqual((received['data']['content'], received['data']['direction']), ('hello', 'received'))
+
+    def test_rollback_publishes_nothing(self):
+        with mock.patch.object(fanout, 'publish', new=mock.AsyncMock()) as publish:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                ChatHistory.objects.create(chat=self.chat, sender=self.user, content='hello')
+                raise RuntimeError()
+
+        publish.assert_not_called()
+
+    def test_failed_publish_is_counted(self):
+        failures = fanout.failures_counter.value()
+
+        async def run():
+            fanout.dispatch_many([ChatHistory(pk=1, chat=self.chat, sender=self.user, content='hello',
+                                              created_at=datetime.datetime.now())])
+            await asyncio.sleep(0.01)
+
+        # Recipients are stubbed, the rows of the scheduled fan-out are never saved.
+        with mock.patch.object(fanout, 'publish', new=mock.AsyncMock(side_effect=RuntimeError)), \
+                mock.patch.object(fanout, 'build_events', new=lambda rows: {'user.1': ['event']}):
+            with self.assertLogs('chat.fanout', 'ERROR'):
+                async_to_sync(run)()
+            with self.assertLogs('chat.fanout', 'ERROR'):
+                ChatHistory.objects.create(chat=self.chat, sender=self.user, content='hello')
+
+        self.assertEqual(fanout.failures_counter.value(), failures + 2)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class BenchmarkTestCase(TransactionTestCase):
+    def test_benchmark_report(self):
+        report = async_to_sync(run_benchmark)(clients=4, messages=3, timeout=5)
+
+        self.assertEqual(report["clients"], 4)
+        self.assertEqual(report["messages"]["sent"], 12)
+        self.assertEqual(report["messages"]["delivered"], 12)
+        self.assertEqual(report["fanout_latency_ms"]["count"], 12)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class CodecTestCase(TransactionTestCase):
+    def test_msgpack_subprotocol(self):
+        async def run():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat', subprotocols=['lbdev-chat.msgpack'])
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual(subprotocol, 'lbdev-chat.msgpack')
+            info = codecs.MessagePackCodec().decode(await communicator.receive_from())
+            self.assertEqual(info["type"], "info")
+
+            await communicator.send_to(bytes_data=codecs.MessagePackCodec().encode({"type": "unknown", "data": {}}))
+            response = codecs.MessagePackCodec().decode(await communicator.receive_from())
+            self.assertEqual(response["type"], "type_not_found")
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_msgpack_round_trip(self):
+        codec = codecs.MessagePackCodec()
+        content = {"pk": uuid.uuid4(), "time": datetime.datetime(2021, 10, 9, tzinfo=datetime.timezone.utc)}
+
+        decoded = codec.decode(codec.encode(content))
+
+        self.assertEqual(decoded["pk"], str(content["pk"]))
+        self.assertEqual(decoded["time"], content["time"])
+
+
+class BatchConsumer:
+    def __init__(self, codec):
+        self.codec = codec
+        self.frames = []
+
+    async def send(self, text_data=None, bytes_data=None):
+        self.frames.append(self.codec.decode(bytes_data if self.codec.binary else text_data))
+
+
+class BatchTestCase(TransactionTestCase):
+    def test_batch_framing(self):
+        for codec in (codecs.JsonCodec(), codecs.MessagePackCodec()):
+            events = [codec.encode({"type": "message", "data": {"id": index}}) for index in range(2)]
+
+            self.assertEqual(codec.decode(codec.encode_batch(events)), {"type": "batch", "data": [
+                {"type": "message", "data": {"id": 0}}, {"type": "message", "data": {"id": 1}}
+            ]})
+
+    @override_settings(CHAT_BATCH_WINDOW_MS=20, CHAT_BATCH_MAX_BYTES=65536, CHAT_BATCH_BYPASS={'resync'})
+    def test_window_flush_and_bypass(self):
+        consumer = BatchConsumer(codecs.MessagePackCodec())
+
+        async def run():
+            batcher = OutboundBatcher(consumer)
+            await batcher.send("message", {"id": 1})
+            await batcher.send("receipt", {"id": 1})
+            self.assertEqual(consumer.frames, [])
+            await asyncio.sleep(0.05)
+            await batcher.send("message", {"id": 2})
+            await batcher.send("resync", {})
+            batcher.close()
+
+        async_to_sync(run)()
+        self.assertEqual(consumer.frames, [
+            {"type": "batch", "data": [{"type": "message", "data": {"id": 1}}, {"type": "receipt", "data": {"id": 1}}]},
+            {"type": "message", "data": {"id": 2}},
+            {"type": "resync", "data": {}},
+        ])
+
+    @override_settings(CHAT_BATCH_WINDOW_MS=10000, CHAT_BATCH_MAX_BYTES=100)
+    def test_byte_budget_flush(self):
+        consumer = BatchConsumer(codecs.JsonCodec())
+
+        async def run():
+            batcher = OutboundBatcher(consumer)
+            for index in range(3):
+                await batcher.send("message", {"content": "x" * 40, "id": index})
+            batcher.close()
+
+        async_to_sync(run)()
+        self.assertEqual([[event["data"]["id"] for event in frame["data"]] for frame in consumer.frames], [[0, 1]])
+
+
+class QueueConsumer:
+    def __init__(self):
+        self.delivered = []
+        self.resynced = False
+        self.gate = None
+
+    async def deliver(self, response_type, data):
+        await self.gate.wait()
+        if data.get("fail"):
+            raise RuntimeError()
+        self.delivered.append((response_type, data))
+
+    async def resync_and_close(self):
+        self.resynced = True
+
+
+@override_settings(CHAT_SEND_QUEUE_SIZE=3, CHAT_EPHEMERAL_TYPES={'presence'})
+class OutboundQueueTestCase(TransactionTestCase):
+    def fill(self, policy, events):
+        consumer = QueueConsumer()
+
+        async def run():
+            # Created on the loop of the test, Python 3.8 binds an Event to the loop current at construction.
+            consumer.gate = asyncio.Event()
+            with override_settings(CHAT_SEND_QUEUE_POLICY=policy):
+                queue = OutboundQueue(consumer)
+            # The writer takes the first event and waits on the gate, the rest stays queued.
+            queue.put("message", {"pk": 0})
+            await asyncio.sleep(0)
+            accepted = [queue.put(response_type, data) for response_type, data in events]
+            consumer.gate.set()
+            await asyncio.sleep(0.01)
+            queue.close()
+            return accepted
+
+        return consumer, async_to_sync(run)()
+
+    def test_drop_oldest(self):
+        drops = outbound.drops_counter.value(policy='drop_oldest', type='presence')
+
+        consumer, accepted = self.fill('drop_oldest', [
+            ("presence", {"pk": 1}), ("message", {"pk": 2}), ("presence", {"pk": 3}), ("message", {"pk": 4})
+        ])
+
+        self.assertEqual(accepted, [True, True, True, True])
+        self.assertEqual([data["pk"] for response_type, data in consumer.delivered], [0, 2, 3, 4])
+        self.assertEqual(outbound.drops_counter.value(policy='drop_oldest', type='presence'), drops + 1)
+
+    def test_collapse(self):
+        consumer, accepted = self.fill('collapse', [
+            ("presence", {"pk": 1, "online": True}), ("presence", {"pk": 2}), ("message", {"pk": 3}),
+            ("presence", {"pk": 1, "online": False})
+        ])
+
+        self.assertEqual(accepted, [True, True, True, True])
+        self.assertEqual(consumer.delivered, [
+            ("message", {"pk": 0}), ("presence", {"pk": 2}), ("message", {"pk": 3}),
+            ("presence", {"pk": 1, "online": False})
+        ])
+
+    def test_disconnect_sends_resync(self):
+        overflows = outbound.overflows_counter.value(policy='disconnect')
+
+        consumer, accepted = self.fill('disconnect', [("presence", {"pk": index}) for index in range(1, 5)])
+
+        self.assertEqual(accepted, [True, True, True, False])
+        self.assertTrue(consumer.resynced)
+        # The queue is discarded, the event being written included.
+        self.assertEqual(consumer.delivered, [])
+        self.assertEqual(outbound.overflows_counter.value(policy='disconnect'), overflows + 1)
+
+    def test_depth_is_observed(self):
+        depths = outbound.depth_histogram.value()["count"]
+
+        self.fill('disconnect', [("message", {"pk": 1}), ("message", {"pk": 2})])
+
+        self.assertEqual(outbound.depth_histogram.value()["count"], depths + 3)
+        self.assertEqual(outbound.queued_gauge.value(), 0)
+
+    def test_failed_delivery_keeps_the_writer(self):
+        with self.assertLogs('chat.outbound', 'ERROR'):
+            consumer, accepted = self.fill('disconnect', [("message", {"fail": True}), ("message", {"pk": 2})])
+
+        self.assertEqual([data["pk"] for response_type, data in consumer.delivered], [0, 2])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MultiDeviceTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.contact = User.objects.create(username='contact')
+        self.chat = Chat.objects.create()
+        self.chat.members.add(self.user, self.contact)
+        self.token = Token.objects.create(user=self.user).key
+        self.contact_token = Token.objects.create(user=self.contact).key
+
+    def tearDown(self):
+        presence._local_presence.clear()
+
+    async def connect(self, token, device):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat')
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.send_json_to({"type": "authorization", "data": {"token": token, "device": device}})
+        response = await communicator.receive_json_from()
+        return communicator, response["data"]
+
+    async def receive(self, communicator, response_type):
+        while True:
+            response = await communicator.receive_json_from(timeout=1)
+            if response["type"] == response_type:
+                return response["data"]
+
+    def test_every_device_receives_messages(self):
+        async def run():
+            phone, _ = await self.connect(self.token, "phone")
+            laptop, _ = await self.connect(self.token, "laptop")
+            sender, _ = await self.connect(self.contact_token, "sender")
+
+            await sender.send_json_to({"type": "message", "data": {"to": str(self.chat.pk), "content": "hello"}})
+            for communicator in (phone, laptop):
+                self.assertEqual((await self.receive(communicator, "message"))["data"]["content"], "hello")
+
+            await asyncio.gather(phone.disconnect(), laptop.disconnect(), sender.disconnect())
+
+        async_to_sync(run)()
+        self.assertEqual(ChatSession.objects.filter(user=self.user).count(), 2)
+
+    def test_resume_skips_seen_messages(self):
+        async def run():
+            phone, response = await self.connect(self.token, "phone")
+            self.assertEqual(response["device"], "phone")
+            sender, _ = await self.connect(self.contact_token, "sender")
+            await sender.send_json_to({"type": "message", "data": {"to": str(self.chat.pk), "content": "seen"}})
+            await self.receive(phone, "message")
+            await phone.disconnect()
+
+            await sender.send_json_to({"type": "message", "data": {"to": str(self.chat.pk), "content": "unseen"}})
+            await self.receive(sender, "message_response")
+
+            phone, response = await self.connect(self.token, "phone")
+            await phone.send_json_to({"type": "resume", "data": {}})
+            page = await self.receive(phone, "resume_response")
+
+            await asyncio.gather(phone.disconnect(), sender.disconnect())
+            return response, page
+
+        response, page = async_to_sync(run)()
+        self.assertEqual(response["last_seen"], ChatHistory.objects.get(content="seen").pk)
+        self.assertEqual([message["content"] for message in page["messages"]], ["unseen"])
+        self.assertFalse(page["more"])
+
+    def test_resume_rejects_invalid_arguments(self):
+        manager = ChatManager(consumer=None)
+        manager.user = self.user
+
+        for data, message in (({"since": "x"}, "Invalid since"), ({"limit": "x"}, "Invalid limit")):
+            response = async_to_sync(run_resolver)(manager.resolvers["resume"], manager, data)
+            self.assertEqual(response, {"status": "error", "message": message})
+
+
+class DirectChatTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.contact = User.objects.create(username='contact')
+
+    def test_pair_key_is_order_independent(self):
+        chat, created = Chat.objects.get_or_create_direct(self.user.id, self.contact.id)
+        self.assertTrue(created)
+
+        with self.assertNumQueries(1):
+            same, created = Chat.objects.get_or_create_direct(self.contact.id, self.user.id)
+        self.assertFalse(created)
+        self.assertEqual(same.pk, chat.pk)
+        self.assertEqual(set(chat.members.values_list('id', flat=True)), {self.user.id, self.contact.id})
+
+    def test_lost_race_returns_existing_chat(self):
+        chat, created = Chat.objects.get_or_create_direct(self.user.id, self.contact.id)
+        # The first lookup misses as if the other caller had not committed yet.
+        with mock.patch('chat.models.ChatQuerySet.get', side_effect=[Chat.DoesNotExist, chat]):
+            same, created = Chat.objects.get_or_create_direct(self.contact.id, self.user.id)
+
+        self.assertFalse(created)
+        self.assertEqual(same.pk, chat.pk)
+        self.assertEqual(Chat.objects.count(), 1)
+
+    @unittest.skipIf(connection.vendor == 'sqlite', 'SQLite locks the whole table for concurrent writers')
+    def test_concurrent_creation_returns_one_chat(self):
+        barrier = threading.Barrier(8)
+        results = []
+
+        def open_chat():
+            try:
+                barrier.wait()
+                results.append(Chat.objects.get_or_create_direct(self.user.id, self.contact.id))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=open_chat) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 8)
+        self.assertEqual({chat.pk for chat, created in results}, {Chat.objects.get().pk})
+        self.assertEqual(sum(created for chat, created in results), 1)
+
+
+class HistoryTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.contact = User.objects.create(username='contact')
+        self.chat, created = Chat.objects.get_or_create_direct(self.user.id, self.contact.id)
+        for index in range(5):
+            ChatHistory.objects.create(chat=self.chat, sender=self.user, content=str(index))
+        self.manager = ChatManager(consumer=None)
+        self.manager.user = self.user
+
+    def get_history(self, data):
+        return async_to_sync(run_resolver)(self.manager.resolvers["get_history"], self.manager, data)
+
+    def contents(self, page):
+        return [message["content"] for message in page["messages"]]
+
+    def test_pages_walk_both_directions(self):
+        pages = [self.get_history({"chat": str(self.chat.pk), "limit": 2})]
+        while pages[-1]["before"]:
+            pages.append(self.get_history({"chat": str(self.chat.pk), "cursor": pages[-1]["before"], "limit": 2}))
+        self.assertEqual([self.contents(page) for page in pages], [['3', '4'], ['1', '2'], ['0']])
+
+        forward = [pages[-1]]
+        while forward[-1]["after"]:
+            forward.append(self.get_history(
+                {"chat": str(self.chat.pk), "cursor": forward[-1]["after"], "direction": "after", "limit": 2}
+            ))
+        self.assertEqual([self.contents(page) for page in forward], [['0'], ['1', '2'], ['3', '4']])
+
+    @override_settings(CHAT_HISTORY_MAX_PAGE_SIZE=3)
+    def test_page_size_is_capped(self):
+        page = self.get_history({"chat": str(self.chat.pk), "limit": 100})
+
+        self.assertEqual(self.contents(page), ['2', '3', '4'])
+        self.assertIsNotNone(page["before"])
+
+    def test_invalid_requests_answer_errors(self):
+        naive_cursor = history.encode_cursor(datetime.datetime(2020, 1, 1), 1)
+        for data, message in (
+            ({}, "Chat not found"),
+            ({"chat": "abc"}, "Chat not found"),
+            ({"chat": str(uuid.uuid4())}, "Chat not found"),
+            ({"chat": str(self.chat.pk), "limit": "abc"}, "Invalid limit"),
+            ({"chat": str(self.chat.pk), "cursor": "abc"}, "Invalid cursor"),
+            ({"chat": str(self.chat.pk), "cursor": 1}, "Invalid cursor"),
+            ({"chat": str(self.chat.pk), "cursor": naive_cursor}, "Invalid cursor"),
+        ):
+            self.assertEqual(self.get_history(data), {"status": "error", "message": message})
+
+
+class ArchiveTestCase(TransactionTestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_override = override_settings(MEDIA_ROOT=media_root.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+
+        self.user = User.objects.create(username='owner')
+        self.contact = User.objects.create(username='contact')
+        self.chat, created = Chat.objects.get_or_create_direct(self.user.id, self.contact.id)
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for index in range(10):
+            chat_history = ChatHistory.objects.create(chat=self.chat, sender=self.user, content=str(index))
+            # The first 7 messages are old enough to be archived.
+            age = datetime.timedelta(days=100 - index) if index < 7 else datetime.timedelta(minutes=10 - index)
+            ChatHistory.objects.filter(pk=chat_history.pk).update(created_at=now - age)
+
+    def contents(self, page):
+        return [message["content"] for message in page["messages"]]
+
+    def test_command_archives_in_batches(self):
+        out = io.StringIO()
+        call_command('archive_history', batch_size=3, stdout=out)
+
+        self.assertIn('Archived 7 messages in 3 batches', out.getvalue())
+        self.assertEqual(ChatHistory.objects.count(), 3)
+        self.assertEqual(sorted(ArchiveSegment.objects.values_list('count', flat=True)), [1, 3, 3])
+
+    def test_history_reads_archived_messages(self):
+        archive.archive_batch(archive.get_cutoff(), batch_size=4)
+        archive.archive_batch(archive.get_cutoff(), batch_size=4)
+
+        pages = [history.get_history_page(self.chat.pk, self.user.id, limit=4)]
+        while pages[-1]["before"]:
+            pages.append(history.get_history_page(self.chat.pk, self.user.id, cursor=pages[-1]["before"], limit=4))
+        self.assertEqual([self.contents(page) for page in pages], [['6', '7', '8', '9'], ['2', '3', '4', '5'],
+                                                                   ['0', '1']])
+
+        forward = history.get_history_page(self.chat.pk, self.user.id, cursor=pages[-1]["after"],
+                                           direction=history.AFTER, limit=5)
+        self.assertEqual(self.contents(forward), ['2', '3', '4', '5', '6'])
+
+    def test_naive_cursor_is_rejected_before_reading_archives(self):
+        archive.archive_batch(archive.get_cutoff(), batch_size=4)
+
+        with self.assertRaises(history.CursorError):
+            history.get_history_page(
+                self.chat.pk, self.user.id, cursor=history.encode_cursor(datetime.datetime(2020, 1, 1), 1)
+            )
+
+
+class SearchTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.contact = User.objects.create(username='contact')
+        self.stranger = User.objects.create(username='stranger')
+        self.chat, created = Chat.objects.get_or_create_direct(self.user.id, self.contact.id)
+        self.other_chat, created = Chat.objects.get_or_create_direct(self.contact.id, self.stranger.id)
+
+        for content in ('Reunião amanhã cedo', 'reuniao reuniao amanha', 'almoço amanhã?', 'nada a ver'):
+            ChatHistory.objects.create(chat=self.chat, sender=self.contact, content=content)
+        ChatHistory.objects.create(chat=self.other_chat, sender=self.stranger, content='reunião secreta')
+
+    def contents(self, page):
+        return [result["content"] for result in page["results"]]
+
+    def test_results_are_ranked_and_scoped(self):
+        page = search.search_messages(self.user.id, 'REUNIÃO amanhã', limit=10)
+
+        self.assertEqual(self.contents(page), ['reuniao reuniao amanha', 'Reunião amanhã cedo', 'almoço amanhã?'])
+        self.assertEqual(page["results"][0]["direction"], 'received')
+        self.assertIsNone(page["next"])
+
+    def test_pagination(self):
+        first = search.search_messages(self.user.id, 'amanha', limit=2)
+        second = search.search_messages(self.user.id, 'amanha', offset=first["next"], limit=2)
+
+        self.assertEqual(len(first["results"]), 2)
+        self.assertEqual(len(second["results"]), 1)
+        self.assertIsNone(second["next"])
+
+    def test_rebuild_command(self):
+        MessageTerm.objects.all().delete()
+        out = io.StringIO()
+        call_command('rebuild_search_index', batch_size=2, stdout=out)
+
+        self.assertIn('Indexed 5 messages', out.getvalue())
+        self.assertEqual(len(search.search_messages(self.stranger.id, 'secreta')["results"]), 1)
+
+    def test_reindexed_messages_keep_their_score(self):
+        # A message written while a rebuild runs is indexed by both.
+        search.index_messages(ChatHistory.objects.all())
+
+        self.assertEqual(MessageTerm.objects.filter(term='reuniao').count(), 3)
+        self.assertEqual(
+            self.contents(search.search_messages(self.user.id, 'reuniao amanha')),
+            ['reuniao reuniao amanha', 'Reunião amanhã cedo', 'almoço amanhã?']
+        )
+
+    def test_benchmark_report(self):
+        report = run_search_benchmark(messages=200, queries=5)
+
+        self.assertEqual(report["messages"], 200)
+        self.assertEqual(report["search_latency_ms"]["count"], 5)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class SnapshotTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.contact = User.objects.create(username='contact', first_name='Contact', last_name='0')
+        self.chat, created = Chat.objects.get_or_create_direct(self.user.id, self.contact.id)
+        self.messages = [
+            ChatHistory.objects.create(chat=self.chat, sender=self.contact, content='message {}'.format(index))
+            for index in range(3)
+        ]
+        ChatHistory.objects.create(chat=self.chat, sender=self.user, content='reply')
+        self.manager = ChatManager(consumer=None)
+        self.manager.user = self.user
+
+    def unread(self, user):
+        return ChatMemberState.objects.get(chat=self.chat, user=user).unread
+
+    def test_contacts_have_unread_and_last_message(self):
+        contact, = async_to_sync(run_resolver)(self.manager.resolvers["get_contacts"], self.manager, {})
+
+        self.assertEqual(contact["unread"], 3)
+        self.assertEqual(contact["last_message"]["content"], 'reply')
+        self.assertEqual(contact["last_message"]["direction"], 'send')
+        self.assertEqual(self.unread(self.contact), 1)
+
+    def test_receipt_recounts_unread(self):
+        async_to_sync(receipt_coalescer.apply)({(self.chat.pk, self.user.id): self.messages[1].pk})
+
+        self.assertEqual(self.unread(self.user), 1)
+
+    def test_repair_command(self):
+        ChatMemberState.objects.update(unread=42)
+        Chat.objects.update(last_message_id=None, last_message_content='')
+
+        call_command('repair_chat_snapshots', stdout=io.StringIO())
+
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_content, 'reply')
+        self.assertEqual((self.unread(self.user), self.unread(self.contact)), (3, 1))
+
+    def test_repair_counts_from_each_member_cursor(self):
+        member = User.objects.create(username='member')
+        chat = Chat.objects.create()
+        chat.members.add(self.user, self.contact, member)
+        messages = [
+            ChatHistory.objects.create(chat=chat, sender=self.contact, content=str(index)) for index in range(3)
+        ]
+        # The first member to acknowledge sets received_at for everyone.
+        async_to_sync(receipt_coalescer.apply)({(chat.pk, self.user.id): messages[1].pk})
+
+        def unread():
+            return dict(ChatMemberState.objects.filter(chat=chat).values_list('user', 'unread'))
+
+        expected = unread()
+        ChatMemberState.objects.update(unread=42)
+
+        call_command('repair_chat_snapshots', stdout=io.StringIO())
+
+        self.assertEqual(expected, {self.user.id: 1, self.contact.id: 0, member.id: 3})
+        self.assertEqual(unread(), expected)
+
+
+class FakeConsumer:
+    channel_name = 'test'
+
+    def __init__(self):
+        self.responses = []
+
+    async def send_response(self, response_type, data):
+        self.responses.append((response_type, data))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], DB_REPLICA_STICKY_SECONDS=60, CHAT_RATE_LIMITS={})
+class ReplicaRoutingTestCase(TransactionTestCase):
+    def setUp(self):
+        self.consumer = FakeConsumer()
+        self.manager = ChatManager(self.consumer)
+        self.manager.user = User.objects.create(username='owner')
+
+    def test_router(self):
+        token = replica_reads.set(True)
+        try:
+            self.assertEqual(Chat.objects.all().db, 'replica')
+            self.assertEqual(router.db_for_write(Chat), 'default')
+        finally:
+            replica_reads.reset(token)
+        self.assertEqual(Chat.objects.all().db, 'default')
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        async def route(context, data):
+            return replica_reads.get()
+
+        resolvers = {"read": MethodResolver(route, read_only=True), "write": MethodResolver(route)}
+        with mock.patch.dict(ChatManager.resolvers, resolvers):
+            for route in ("read", "write", "read"):
+                async_to_sync(self.manager.route_resolve)({"type": route, "data": {}})
+
+        self.assertEqual([data for response_type, data in self.consumer.responses], [True, False, False])
+
+
+@override_settings(
+    DATABASE_REPLICAS=['replica'], DB_REPLICA_STICKY_SECONDS=60, CHAT_RATE_LIMITS={},
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS
+)
+class ReplicaDatabaseTestCase(TransactionTestCase):
+    # The runner sets up the declared databases before setUpClass, a missing replica is only added there.
+    databases = {'default', 'replica'} & set(settings.DATABASES) | {'default'}
+
+    @classmethod
+    def setUpClass(cls):
+        # Without a configured replica a second SQLite file stands in for it, nothing replicates into it.
+        cls.replica_dir = None
+        if 'replica' not in connections.databases:
+            cls.replica_dir = tempfile.TemporaryDirectory()
+            connections.databases['replica'] = {
+                'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(cls.replica_dir.name, 'replica.sqlite3')
+            }
+            call_command('migrate', database='replica', verbosity=0)
+        cls.databases = {'default', 'replica'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if cls.replica_dir is not None:
+            connections['replica'].close()
+            del connections['replica']
+            del connections.databases['replica']
+            cls.replica_dir.cleanup()
+
+    def test_contacts_are_read_from_replica(self):
+        consumer = FakeConsumer()
+        manager = ChatManager(consumer)
+        manager.user = User.objects.create(username='owner')
+        contact = User.objects.create(username='contact')
+        Chat.objects.get_or_create_direct(manager.user.id, contact.id)
+
+        async_to_sync(manager.route_resolve)({"type": "get_contacts", "data": {}})
+        manager.last_write_at = time.monotonic()
+        async_to_sync(manager.route_resolve)({"type": "get_contacts", "data": {}})
+
+        # Nothing replicates between the test databases, only the sticky read sees the chat.
+        self.assertEqual([len(data) for response_type, data in consumer.responses], [0, 1])
+
+
+class ConnectionPoolTestCase(TransactionTestCase):
+    @override_settings(CHAT_DB_POOL_SIZE=2)
+    def test_calls_run_on_the_pool(self):
+        thread_name = async_to_sync(db.database_sync_to_async(lambda: threading.current_thread().name))()
+
+        self.assertTrue(thread_name.startswith('chat-db'))
+
+    def test_calls_run_on_the_shared_thread_without_pool(self):
+        thread_name = async_to_sync(db.database_sync_to_async(lambda: threading.current_thread().name))()
+
+        self.assertEqual(thread_name, threading.current_thread().name)
+
+    @override_settings(CHAT_DB_HEALTH_CHECK_INTERVAL=0)
+    def test_broken_connection_is_closed(self):
+        connection.ensure_connection()
+        failures = db.health_check_failures_counter.value(alias='default')
+        with mock.patch.dict(connection.settings_dict, CONN_MAX_AGE=60), \
+                mock.patch.object(connection, 'is_usable', return_value=False), \
+                mock.patch.object(connection, 'close') as close:
+            db.prepare_connections()
+
+        close.assert_called_once_with()
+        self.assertEqual(db.health_check_failures_counter.value(alias='default'), failures + 1)
+
+
+class ShardedChannelLayerTestCase(TransactionTestCase):
+    def test_adding_a_shard_moves_few_keys(self):
+        keys = range(10000)
+        before = [jump_hash(key * 7919, 4) for key in keys]
+        after = [jump_hash(key * 7919, 5) for key in keys]
+
+        moved = sum(old != new for old, new in zip(before, after))
+        self.assertTrue(all(new == 4 for old, new in zip(before, after) if old != new))
+        self.assertLess(moved, 2500)
+        self.assertEqual(sorted(set(before)), [0, 1, 2, 3])
+
+    def test_groups_spread_over_hosts(self):
+        layer = ShardedRedisChannelLayer(hosts=['redis://a', 'redis://b', 'redis://c'])
+
+        shards = [layer.consistent_hash('user.{}'.format(index)) for index in range(3000)]
+
+        self.assertEqual(layer.consistent_hash('user.1'), shards[1])
+        self.assertTrue(all(800 < shards.count(shard) < 1200 for shard in range(3)))
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_GROUP_REFRESH_SECONDS=0.05)
+    def test_group_membership_is_restored(self):
+        user = User.objects.create(username='owner')
+        token = Token.objects.create(user=user).key
+
+        async def run():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat')
+            await communicator.connect()
+            await communicator.receive_json_from()
+            await communicator.send_json_to({"type": "authorization", "data": {"token": token}})
+            await communicator.receive_json_from()
+
+            # A restarted shard loses its groups.
+            get_channel_layer().groups.clear()
+            await asyncio.sleep(0.2)
+            await get_channel_layer().group_send('user.{}'.format(user.id), {
+                "type": "send_message", "data": {"type": "presence", "data": {"pk": "1", "online": True}}
+            })
+            response = await communicator.receive_json_from(timeout=1)
+            await communicator.disconnect()
+            presence._local_presence.clear()
+            return response
+
+        self.assertEqual(async_to_sync(run)()["type"], "presence")
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_GROUP_REFRESH_SECONDS=0.02)
+    def test_refresh_in_flight_does_not_outlive_disconnect(self):
+        user = User.objects.create(username='owner')
+        token = Token.objects.create(user=user).key
+        layer = get_channel_layer()
+        group_add = layer.group_add
+
+        async def slow_group_add(group, channel):
+            await asyncio.sleep(0.05)
+            await group_add(group, channel)
+
+        async def run():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat')
+            await communicator.connect()
+            await communicator.receive_json_from()
+            await communicator.send_json_to({"type": "authorization", "data": {"token": token}})
+            await communicator.receive_json_from(timeout=1)
+            # The first refresh runs after 10 to 20ms and is still adding.
+            await asyncio.sleep(0.03)
+            await communicator.disconnect()
+            await asyncio.sleep(0.1)
+            presence._local_presence.clear()
+            return layer.groups.get('user.{}'.format(user.id), {})
+
+        with mock.patch.object(layer, 'group_add', new=slow_group_add):
+            self.assertEqual(async_to_sync(run)(), {})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class LocalDeliveryTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.contact = User.objects.create(username='contact')
+        self.chat = Chat.objects.create()
+        self.chat.members.add(self.user, self.contact)
+        self.token = Token.objects.create(user=self.user).key
+        self.contact_token = Token.objects.create(user=self.contact).key
+
+    def tearDown(self):
+        presence._local_presence.clear()
+
+    async def connect(self, token):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/chat')
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.send_json_to({"type": "authorization", "data": {"token": token}})
+        await communicator.receive_json_from()
+        return communicator
+
+    async def exchange(self):
+        phone = await self.connect(self.token)
+        sender = await self.connect(self.contact_token)
+        local, remote = fanout.deliveries_counter.value(path="local"), fanout.deliveries_counter.value(path="remote")
+        await sender.send_json_to({"type": "message", "data": {"to": str(self.chat.pk), "content": "hello"}})
+        received = [await phone.receive_json_from(timeout=1)]
+        # A copy coming back through the channel layer would show up here.
+        while not await phone.receive_nothing(timeout=0.2):
+            received.append(await phone.receive_json_from())
+        local = fanout.deliveries_counter.value(path="local") - local
+        remote = fanout.deliveries_counter.value(path="remote") - remote
+        await asyncio.gather(phone.disconnect(), sender.disconnect())
+        return [response for response in received if response["type"] == "message"], local, remote
+
+    def test_local_sockets_skip_the_channel_layer(self):
+        messages, local, remote = async_to_sync(self.exchange)()
+
+        self.assertEqual([message["data"]["data"]["content"] for message in messages], ["hello"])
+        self.assertGreater(local, 0)
+        self.assertEqual(remote, 0)
+
+    def test_remote_devices_go_through_the_channel_layer(self):
+        # A device of the recipient connected to another process.
+        async_to_sync(presence.get_presence().connect)(self.user.id, 'remote')
+
+        messages, local, remote = async_to_sync(self.exchange)()
+
+        self.assertEqual([message["data"]["data"]["content"] for message in messages], ["hello"])
+        self.assertEqual(remote, 1)
+
+    async def send(self, phone, sender, content):
+        await sender.send_json_to({"type": "message", "data": {"to": str(self.chat.pk), "content": content}})
+        while (await phone.receive_json_from(timeout=1))["type"] != "message":
+            pass
+
+    def test_presence_is_read_once_per_change(self):
+        async def run():
+            phone = await self.connect(self.token)
+            sender = await self.connect(self.contact_token)
+            await self.send(phone, sender, "first")
+            lookups = local.presence_lookups_counter.value()
+            for content in ("second", "third"):
+                await self.send(phone, sender, content)
+            cached = local.presence_lookups_counter.value() - lookups
+
+            # Another process opens a connection of the recipient.
+            await presence.user_connected(self.user.id, 'remote')
+            await asyncio.sleep(0.05)
+            remote = fanout.deliveries_counter.value(path="remote")
+            await self.send(phone, sender, "fourth")
+            remote = fanout.deliveries_counter.value(path="remote") - remote
+
+            await asyncio.gather(phone.disconnect(), sender.disconnect())
+            return cached, remote
+
+        self.assertEqual(async_to_sync(run)(), (0, 1))
+
+
+class WriteBufferTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.chat = Chat.objects.create()
+        self.chat.members.add(self.user)
+
+    def row(self, content, chat_id=None):
+        return ChatHistory(content=content, chat_id=chat_id or self.chat.pk, sender=self.user)
+
+    def test_flush_by_size(self):
+        buffer = ChatHistoryBuffer(window=10000, batch_size=2)
+
+        async def run():
+            with mock.patch.object(buffer, 'write', wraps=buffer.write) as write:
+                rows = await asyncio.wait_for(asyncio.gather(buffer.add(self.row('a')), buffer.add(self.row('b'))), 1)
+            return rows, write.call_count
+
+        rows, writes = async_to_sync(run)()
+        self.assertEqual(writes, 1)
+        self.assertEqual(
+            list(ChatHistory.objects.order_by('id').values_list('pk', flat=True)), [row.pk for row in rows]
+        )
+
+    def test_flush_by_window_acks_after_commit(self):
+        buffer = ChatHistoryBuffer(window=50, batch_size=100)
+
+        async def run():
+            task = asyncio.ensure_future(buffer.add(self.row('a')))
+            await asyncio.sleep(0.01)
+            self.assertFalse(task.done())
+            return await asyncio.wait_for(task, 1)
+
+        chat_history = async_to_sync(run)()
+        self.assertTrue(ChatHistory.objects.filter(pk=chat_history.pk, content='a').exists())
+
+    def test_failure_reaches_every_sender(self):
+        buffer = ChatHistoryBuffer(window=10000, batch_size=2)
+        errors = flush_errors_counter.value()
+
+        async def run():
+            with mock.patch.object(buffer, 'write', new=mock.AsyncMock(side_effect=RuntimeError)):
+                return await asyncio.gather(
+                    buffer.add(self.row('a')), buffer.add(self.row('b')), return_exceptions=True
+                )
+
+        results = async_to_sync(run)()
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(flush_errors_counter.value(), errors + 1)
+
+    def test_missing_chat_only_fails_its_row(self):
+        buffer = ChatHistoryBuffer(window=10000, batch_size=2)
+
+        async def run():
+            return await asyncio.gather(
+                buffer.add(self.row('a')), buffer.add(self.row('b', chat_id=uuid.uuid4())), return_exceptions=True
+            )
+
+        saved, missing = async_to_sync(run)()
+        self.assertIsInstance(missing, Chat.DoesNotExist)
+        self.assertEqual(list(ChatHistory.objects.values_list('pk', flat=True)), [saved.pk])
+
+    def test_failed_batch_only_fails_the_bad_row(self):
+        buffer = ChatHistoryBuffer(window=10000, batch_size=3)
+        index_messages = search.index_messages
+
+        def reject_bad_rows(chat_histories):
+            if any(chat_history.content == 'bad' for chat_history in chat_histories):
+                raise ValueError('bad row')
+            return index_messages(chat_histories)
+
+        async def run():
+            return await asyncio.gather(
+                buffer.add(self.row('a')), buffer.add(self.row('bad')), buffer.add(self.row('b')),
+                return_exceptions=True
+            )
+
+        # Both write paths index the rows, bulk_create and the per row save of backends without RETURNING.
+        with mock.patch.object(search, 'index_messages', side_effect=reject_bad_rows), \
+                self.assertLogs('chat.buffers', 'WARNING'):
+            first, bad, second = async_to_sync(run)()
+
+        self.assertIsInstance(bad, ValueError)
+        self.assertEqual(list(ChatHistory.objects.order_by('id').values_list('content', flat=True)), ['a', 'b'])
+        self.assertEqual([first.content, second.content], ['a', 'b'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PresenceTestCase(TransactionTestCase):
+    def tearDown(self):
+        presence._local_presence.clear()
+
+    def test_connections_are_counted_once(self):
+        async def run():
+            registry = presence.get_presence()
+            await registry.connect(1, 'phone')
+            await registry.connect(1, 'laptop')
+            await registry.disconnect(1, 'phone')
+            await registry.disconnect(1, 'phone')
+            return await registry.count(1), await registry.online_many([1, 2])
+
+        self.assertEqual(async_to_sync(run)(), (1, {1: True, 2: False}))
+
+    @override_settings(CHAT_PRESENCE_TTL=1)
+    def test_connections_of_a_dead_worker_expire(self):
+        layer = ShardedRedisChannelLayer(hosts=settings.REDIS_HOSTS, prefix='test-presence')
+
+        async def run():
+            registry = presence.RedisPresence(layer)
+            try:
+                await registry.connect(1, 'phone')
+            except (OSError, asyncio.TimeoutError):
+                raise unittest.SkipTest('redis is not reachable')
+            # The worker dies: nobody refreshes or removes its connection.
+            registry._heartbeat.cancel()
+            alive = await registry.count(1)
+            await asyncio.sleep(1.1)
+            return alive, await registry.count(1), await registry.online_many([1])
+
+        self.assertEqual(async_to_sync(run)(), (1, 0, {1: False}))
+
+
+@override_settings(CHAT_RATE_LIMITS={})
+class ReceiptTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.contact = User.objects.create(username='contact')
+        self.chats = [Chat.objects.create(), Chat.objects.create()]
+        self.messages = {}
+        for chat in self.chats:
+            chat.members.add(self.user, self.contact)
+            self.messages[chat.pk] = [
+                ChatHistory.objects.create(chat=chat, sender=self.contact, content=str(index)).pk for index in range(3)
+            ]
+
+    def test_routes_need_authorization(self):
+        consumer = FakeConsumer()
+        manager = ChatManager(consumer)
+
+        for route in ("receipt", "resume", "search_messages"):
+            async_to_sync(manager.route_resolve)({"type": route, "data": {"chat": str(self.chats[0].pk), "id": 1}})
+
+        self.assertEqual(consumer.responses, [
+            ("{}_response".format(route), {"status": "error", "message": "Not authorized"})
+            for route in ("receipt", "resume", "search_messages")
+        ])
+
+    def test_flush_runs_one_update_per_chat_and_one_event_per_sender(self):
+        coalescer = ReceiptCoalescer(interval=10000)
+        first, second = self.chats
+        updates = []
+        update = QuerySet.update
+
+        def count_update(queryset, **kwargs):
+            if queryset.model is ChatHistory:
+                updates.append(kwargs)
+            return update(queryset, **kwargs)
+
+        async def run():
+            for message_id in (self.messages[first.pk][1], self.messages[first.pk][0], self.messages[first.pk][2]):
+                coalescer.add(first.pk, self.user.id, message_id)
+            coalescer.add(second.pk, self.user.id, self.messages[second.pk][1])
+            await coalescer.flush()
+
+        with mock.patch.object(fanout, 'publish', new=mock.AsyncMock()) as publish, \
+                mock.patch.object(QuerySet, 'update', autospec=True, side_effect=count_update):
+            async_to_sync(run)()
+
+        self.assertEqual(len(updates), 2)
+        events = publish.call_args[0][0]
+        group = 'user.{}'.format(self.contact.id)
+        self.assertEqual(list(events), [group])
+        receipts = sorted((event["data"]["data"]["pk"], event["data"]["data"]["id"]) for event in events[group])
+        self.assertEqual(receipts, sorted([
+            (str(first.pk), self.messages[first.pk][2]), (str(second.pk), self.messages[second.pk][1])
+        ]))
+        self.assertEqual(ChatHistory.objects.filter(received_at__isnull=True).count(), 1)
+
+    def test_failed_flush_keeps_acknowledgements(self):
+        coalescer = ReceiptCoalescer(interval=10000)
+        chat = self.chats[0]
+
+        async def run():
+            coalescer.add(chat.pk, self.user.id, self.messages[chat.pk][0])
+            with mock.patch.object(coalescer, 'apply', new=mock.AsyncMock(side_effect=OperationalError)):
+                with self.assertRaises(OperationalError):
+                    await coalescer.flush()
+            coalescer.add(chat.pk, self.user.id, self.messages[chat.pk][1])
+            with mock.patch.object(fanout, 'publish', new=mock.AsyncMock()):
+                await coalescer.flush()
+
+        with self.assertLogs('chat.fanout', 'ERROR'):
+            async_to_sync(run)()
+        self.assertEqual(ChatHistory.objects.filter(received_at__isnull=True).count(), 4)
+
+    def test_failing_acknowledgement_is_dropped_alone(self):
+        coalescer = ReceiptCoalescer(interval=10000)
+        first, second = self.chats
+        record_receipt = receipts.snapshots.record_receipt
+
+        def fail_first_chat(chat_id, user_id, message_id):
+            if chat_id == first.pk:
+                raise ValueError
+            return record_receipt(chat_id, user_id, message_id)
+
+        async def run():
+            coalescer.add(first.pk, self.user.id, self.messages[first.pk][2])
+            coalescer.add(second.pk, self.user.id, self.messages[second.pk][2])
+            await coalescer.flush()
+            self.assertEqual(coalescer._pending, {})
+
+        with mock.patch.object(fanout, 'publish', new=mock.AsyncMock()) as publish, \
+                mock.patch.object(receipts.snapshots, 'record_receipt', side_effect=fail_first_chat), \
+                self.assertLogs('chat.receipts', 'WARNING'):
+            async_to_sync(run)()
+
+        self.assertEqual(ChatHistory.objects.filter(chat=first, received_at__isnull=True).count(), 3)
+        self.assertEqual(ChatHistory.objects.filter(chat=second, received_at__isnull=True).count(), 0)
+        events = publish.call_args[0][0]
+        self.assertEqual([event["data"]["data"]["pk"] for event in events['user.{}'.format(self.contact.id)]], [
+            str(second.pk)
+        ])
+
+    def test_members_of_a_chat_share_one_update(self):
+        coalescer = ReceiptCoalescer(interval=10000)
+        chat = self.chats[0]
+        own = ChatHistory.objects.create(chat=chat, sender=self.user, content="own").pk
+        updates = []
+        update = QuerySet.update
+
+        def count_update(queryset, **kwargs):
+            if queryset.model is ChatHistory:
+                updates.append(kwargs)
+            return update(queryset, **kwargs)
+
+        async def run():
+            coalescer.add(chat.pk, self.user.id, self.messages[chat.pk][1])
+            coalescer.add(chat.pk, self.contact.id, own)
+            await coalescer.flush()
+
+        with mock.patch.object(fanout, 'publish', new=mock.AsyncMock()), \
+                mock.patch.object(QuerySet, 'update', autospec=True, side_effect=count_update):
+            async_to_sync(run)()
+
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(
+            list(ChatHistory.objects.filter(chat=chat, received_at__isnull=True).values_list("pk", flat=True)),
+            [self.messages[chat.pk][2]]
+        )
+
+    def test_route_rejects_invalid_acknowledgements(self):
+        consumer = FakeConsumer()
+        manager = ChatManager(consumer)
+        manager.user = self.user
+        first, second = self.chats
+        other = Chat.objects.create()
+        foreign = ChatHistory.objects.create(chat=other, sender=self.contact, content="foreign").pk
+
+        with mock.patch.object(receipt_coalescer, 'add') as add:
+            for chat, message_id in (
+                (first.pk, 10 ** 30), (first.pk, 0), (first.pk, "x"), (first.pk, self.messages[second.pk][0]),
+                (other.pk, foreign), (first.pk, self.messages[first.pk][0])
+            ):
+                async_to_sync(manager.route_resolve)({"type": "receipt", "data": {"chat": str(chat), "id": message_id}})
+
+        self.assertEqual([data["message"] for response_type, data in consumer.responses], [
+            "Invalid receipt", "Invalid receipt", "Invalid receipt", "Message not found", "Message not found"
+        ])
+        add.assert_called_once_with(first.pk, self.user.id, self.messages[first.pk][0])
+
+
+class RateLimitTestCase(TransactionTestCase):
+    def take(self, limiter, now, rate=2, burst=3):
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=now):
+            return async_to_sync(limiter.take)('user:1:message', rate, burst)
+
+    def test_burst_then_refill(self):
+        limiter = ratelimit.LocalRateLimiter()
+
+        self.assertEqual([self.take(limiter, 100) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.take(limiter, 100), 0.5)
+        # Half a second refills one token at 2 per second.
+        self.assertEqual(self.take(limiter, 100.5), 0)
+        self.assertGreater(self.take(limiter, 100.5), 0)
+        # A long pause refills the burst, not more.
+        self.assertEqual([self.take(limiter, 200) == 0 for _ in range(4)], [True, True, True, False])
+
+    @override_settings(CHAT_RATE_LIMITS={"message": [1, 1], "default": [5, 10]})
+    def test_route_limits_fall_back_to_default(self):
+        self.assertEqual(ratelimit.get_limit("message"), [1, 1])
+        self.assertEqual(ratelimit.get_limit("get_contacts"), [5, 10])
+
+    @override_settings(CHAT_RATE_LIMITS={"message": [1, 1]})
+    def test_routes_without_limit_are_not_limited(self):
+        self.assertIsNone(ratelimit.get_limit("get_contacts"))
+        self.assertEqual(async_to_sync(ratelimit.check)('user:1', "get_contacts"), 0)
+
+    @override_settings(
+        CHAT_RATE_LIMIT_BACKEND='local', CHAT_RATE_LIMITS={"search_messages": [0.5, 1]}, DATABASE_REPLICAS=[]
+    )
+    def test_rejected_frame_gets_retry_after(self):
+        consumer = FakeConsumer()
+        manager = ChatManager(consumer)
+        manager.user = User.objects.create(username='owner')
+        rejections = ratelimit.rejections_counter.value(route="search_messages")
+
+        with mock.patch.object(ratelimit, '_local_limiter', ratelimit.LocalRateLimiter()):
+            for _ in range(2):
+                async_to_sync(manager.route_resolve)({"type": "search_messages", "data": {"query": "hello"}})
+
+        self.assertEqual(consumer.responses[0][0], "search_messages_response")
+        response_type, data = consumer.responses[1]
+        self.assertEqual((response_type, data["type"]), ("rate_limited", "search_messages"))
+        self.assertGreater(data["retry_after"], 1.9)
+        self.assertEqual(ratelimit.rejections_counter.value(route="search_messages"), rejections + 1)
+
+
+class MetricsTestCase(TransactionTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(metrics.registry, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_render_counters_and_gauges(self):
+        metrics.counter("test_frames_total", "Frames.").inc(2, route="message")
+        metrics.gauge("test_sockets", "Open sockets.").set(1.5)
+
+        self.assertEqual(metrics.render(), "\n".join([
+            '# HELP test_frames_total Frames.',
+            '# TYPE test_frames_total counter',
+            'test_frames_total{route="message"} 2',
+            '# HELP test_sockets Open sockets.',
+            '# TYPE test_sockets gauge',
+            'test_sockets 1.5',
+        ]) + "\n")
+
+    def test_render_histogram_buckets_are_cumulative(self):
+        histogram = metrics.histogram("test_seconds", "Latency.", buckets=(1, 2, 5))
+        for value in (0.5, 3, 10):
+            histogram.observe(value, route="message")
+
+        self.assertEqual(metrics.render().splitlines()[2:], [
+            'test_seconds_bucket{route="message",le="1"} 1',
+            'test_seconds_bucket{route="message",le="2"} 1',
+            'test_seconds_bucket{route="message",le="5"} 2',
+            'test_seconds_bucket{route="message",le="+Inf"} 3',
+            'test_seconds_sum{route="message"} 13.5',
+            'test_seconds_count{route="message"} 3',
+        ])
+
+    def test_render_escapes_label_values(self):
+        metrics.counter("test_total", "Test.").inc(route='a\\b"c\nd')
+
+        self.assertEqual(metrics.render().splitlines()[2], 'test_total{route="a\\\\b\\"c\\nd"} 1')
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_view_is_open_without_token(self):
+        metrics.counter("test_total", "Test.").inc()
+
+        response = self.client.get('/chat/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'test_total 1\n', response.content)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_view_requires_token(self):
+        self.assertEqual(self.client.get('/chat/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/chat/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get('/chat/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
@@ -2,4 +2,6 @@ from django.urls import path
 
 from chat import views
 
-urlpatterns = []
+urlpatterns = [
+    path('metrics', views.metrics, name='metrics'),
+]
@@ -1,4 +1,16 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
 
-# Create your views here.
+from lbdev_chat import metrics as metrics_registry
 
+
+def metrics(request):
+    """
+    Metrics of this process in the Prometheus text format, public unless ``METRICS_TOKEN`` is set.
+    """
+    if settings.METRICS_TOKEN:
+        authorization = request.headers.get("Authorization", "")
+        if not constant_time_compare(authorization, "Bearer {}".format(settings.METRICS_TOKEN)):
+            return HttpResponseForbidden()
+    return HttpResponse(metrics_registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
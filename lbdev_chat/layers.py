@@ -0,0 +1,33 @@
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping & Veach): maps a 64 bit key to one of ``buckets``, moving only ``1 / buckets``
+    of the keys when a bucket is added.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer spreading groups and channels over every host with a jump consistent hash.
+
+    The stock layer already sends a group message only to the shard holding the group and to the shards of its
+    members; its CRC range split remaps most keys when a host is added, this one remaps ``1 / hosts`` of them.
+    """
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        if isinstance(value, str):
+            value = value.encode("utf8")
+        key = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "big")
+        return jump_hash(key, self.ring_size)
@@ -0,0 +1,144 @@
+import random
+import threading
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+registry = {}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][index] += 1
+            state["count"] += 1
+            state["sum"] += value
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0})
+
+
+def _get_or_create(metric_class, name, *args, **kwargs):
+    with _lock:
+        if name not in registry:
+            registry[name] = metric_class(name, *args, **kwargs)
+        return registry[name]
+
+
+def counter(name, documentation):
+    return _get_or_create(Counter, name, documentation)
+
+
+def gauge(name, documentation):
+    return _get_or_create(Gauge, name, documentation)
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, documentation, buckets=buckets)
+
+
+def sampled():
+    """
+    True for the CHAT_LOG_SAMPLE_RATE share of calls, used to keep hot path logging cheap.
+    """
+    return random.random() < settings.CHAT_LOG_SAMPLE_RATE
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(key, extra=()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Render every registered metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in sorted(registry.items()):
+        lines.append("# HELP {} {}".format(name, metric.documentation))
+        lines.append("# TYPE {} {}".format(name, metric.kind))
+        with metric._lock:
+            values = dict(metric._values)
+        for key, value in sorted(values.items()):
+            if metric.kind == "histogram":
+                for bound, count in zip(metric.buckets, value["buckets"]):
+                    lines.append("{}_bucket{} {}".format(name, _format_labels(key, [("le", _format_value(bound))]),
+                                                         count))
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(key, [("le", "+Inf")]), value["count"]))
+                lines.append("{}_sum{} {}".format(name, _format_labels(key), _format_value(value["sum"])))
+                lines.append("{}_count{} {}".format(name, _format_labels(key), value["count"]))
+            else:
+                lines.append("{}{} {}".format(name, _format_labels(key), _format_value(value)))
+    return "\n".join(lines) + "\n"
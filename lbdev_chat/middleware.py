@@ -3,16 +3,24 @@ from channels.middleware import BaseMiddleware
 from django.contrib.auth.models import AnonymousUser
 from rest_framework.authtoken.models import Token
 
+from api.authentication import load_token, token_cache
+
 
 @database_sync_to_async
-def get_user(token_key):
+def _load_user(token_key):
     try:
-        token = Token.objects.get(key=token_key)
-        return token.user
+        return load_token(token_key).user
     except Token.DoesNotExist:
         return AnonymousUser()
 
 
+async def get_user(token_key):
+    token = token_cache.get(token_key)
+    if token is not None:
+        return token.user
+    return await _load_user(token_key)
+
+
 class TokenAuthMiddleware(BaseMiddleware):
 
     def __init__(self, inner):
@@ -0,0 +1,27 @@
+import contextvars
+import random
+
+from django.conf import settings
+
+replica_reads = contextvars.ContextVar("replica_reads", default=False)
+
+
+class ReplicaRouter:
+    """
+    Sends reads to one of DATABASE_REPLICAS while ``replica_reads`` is set, everything else to ``default``.
+
+    The flag is a context variable so it follows the call into the ``database_sync_to_async`` thread; it is only
+    set by read-only chat routes, which are not run right after their connection wrote (see ChatManager).
+    """
+
+    def db_for_read(self, model, **hints):
+        if replica_reads.get() and settings.DATABASE_REPLICAS:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        return True
@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/3.2/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
+import json
 import os
 from pathlib import Path
 
@@ -56,15 +57,64 @@ if os.environ.get('REDIS_URL'):
 else:
     REDIS_HOST = (os.environ.get('REDIS_HOST', 'channel_layer'), os.environ.get('REDIS_PORT', 6379))
 
+# Space separated redis URLs, groups and channels are sharded over all of them.
+REDIS_HOSTS = os.environ.get('REDIS_HOSTS', default='').split() or [REDIS_HOST]
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'lbdev_chat.layers.ShardedRedisChannelLayer',
         'CONFIG': {
-            'hosts': [REDIS_HOST],
+            'hosts': REDIS_HOSTS,
         }
     }
 }
 
+# Chat
+
+CHAT_AUTH_TIMEOUT = float(os.environ.get('CHAT_AUTH_TIMEOUT', default=5))
+CHAT_WRITE_BUFFER = int(os.environ.get('CHAT_WRITE_BUFFER', default=0))
+CHAT_WRITE_BUFFER_WINDOW_MS = float(os.environ.get('CHAT_WRITE_BUFFER_WINDOW_MS', default=5))
+CHAT_WRITE_BUFFER_SIZE = int(os.environ.get('CHAT_WRITE_BUFFER_SIZE', default=100))
+CHAT_GROUP_REFRESH_SECONDS = float(os.environ.get('CHAT_GROUP_REFRESH_SECONDS', default=30))
+CHAT_PRESENCE_TTL = int(os.environ.get('CHAT_PRESENCE_TTL', default=60))
+CHAT_PRESENCE_CACHE_SECONDS = float(os.environ.get('CHAT_PRESENCE_CACHE_SECONDS', default=5))
+CHAT_RECEIPT_FLUSH_MS = float(os.environ.get('CHAT_RECEIPT_FLUSH_MS', default=1000))
+CHAT_BATCH_WINDOW_MS = float(os.environ.get('CHAT_BATCH_WINDOW_MS', default=10))
+CHAT_BATCH_MAX_BYTES = int(os.environ.get('CHAT_BATCH_MAX_BYTES', default=65536))
+CHAT_BATCH_BYPASS = set(os.environ.get('CHAT_BATCH_BYPASS', default='').split())
+CHAT_SEND_QUEUE_SIZE = int(os.environ.get('CHAT_SEND_QUEUE_SIZE', default=1000))
+CHAT_SEND_QUEUE_POLICY = os.environ.get('CHAT_SEND_QUEUE_POLICY', default='drop_oldest')
+CHAT_EPHEMERAL_TYPES = set(os.environ.get('CHAT_EPHEMERAL_TYPES', default='presence receipt').split())
+# Per route token buckets, (tokens per second, burst). The "default" entry applies to routes not listed.
+CHAT_RATE_LIMITS = {
+    'default': (20, 40),
+    'authorization': (1, 5),
+    'message': (10, 30),
+    'get_contacts': (1, 5),
+    'get_contact': (10, 20),
+    'get_history': (5, 20),
+    'receipt': (20, 50),
+    'search_messages': (2, 10),
+    **json.loads(os.environ.get('CHAT_RATE_LIMITS', default='{}'))
+}
+CHAT_RATE_LIMIT_BACKEND = os.environ.get('CHAT_RATE_LIMIT_BACKEND', default='local')
+CHAT_LOG_SAMPLE_RATE = float(os.environ.get('CHAT_LOG_SAMPLE_RATE', default=0.01))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', default=50))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_MAX_PAGE_SIZE', default=200))
+CHAT_DB_POOL_SIZE = int(os.environ.get('CHAT_DB_POOL_SIZE', default=0))
+CHAT_DB_HEALTH_CHECK_INTERVAL = float(os.environ.get('CHAT_DB_HEALTH_CHECK_INTERVAL', default=30))
+CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', default=90))
+CHAT_ARCHIVE_BATCH_SIZE = int(os.environ.get('CHAT_ARCHIVE_BATCH_SIZE', default=1000))
+CHAT_ARCHIVE_CACHE_SIZE = int(os.environ.get('CHAT_ARCHIVE_CACHE_SIZE', default=32))
+
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', default=10000))
+AUTH_TOKEN_CACHE_TTL = float(os.environ.get('AUTH_TOKEN_CACHE_TTL', default=60))
+AUTH_PERMISSION_CACHE_SIZE = int(os.environ.get('AUTH_PERMISSION_CACHE_SIZE', default=10000))
+AUTH_PERMISSION_CACHE_TTL = float(os.environ.get('AUTH_PERMISSION_CACHE_TTL', default=30))
+AUTH_HASH_WORKERS = int(os.environ.get('AUTH_HASH_WORKERS', default=os.cpu_count() or 1))
+AUTH_HASH_MAX_PENDING = int(os.environ.get('AUTH_HASH_MAX_PENDING', default=100))
+
 SWAGGER_SETTINGS = {
     "USE_SESSION_AUTH": False,
     "SECURITY_DEFINITIONS": {
@@ -77,7 +127,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.AllowAny',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
@@ -141,7 +191,42 @@ DB_ENGINE = {
 }
 
 DATABASES = {
-    'default': DB_ENGINE[os.environ.get("DB_ENGINE", "psql")]
+    'default': dict(DB_ENGINE[os.environ.get("DB_ENGINE", "psql")],
+                    CONN_MAX_AGE=int(os.environ.get('DB_CONN_MAX_AGE', default=0)))
+}
+
+# Read replicas share the primary settings but the host, read-only chat routes are routed to them.
+for _index, _host in enumerate(os.environ.get('DB_REPLICA_HOSTS', default='').split()):
+    DATABASES['replica{}'.format(_index)] = dict(DATABASES['default'], HOST=_host, TEST={'MIRROR': 'default'})
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['lbdev_chat.routers.ReplicaRouter']
+DB_REPLICA_STICKY_SECONDS = float(os.environ.get('DB_REPLICA_STICKY_SECONDS', default=5))
+
+
+# Logging
+# https://docs.djangoproject.com/en/3.2/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            'format': 'time=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'structured',
+        },
+    },
+    'loggers': {
+        'chat': {
+            'handlers': ['console'],
+            'level': os.environ.get('CHAT_LOG_LEVEL', default='INFO'),
+        },
+    },
 }
 
 